@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import polars as pl
+
+from plot import (
+    TIME_COL_NAME,
+    VALUE_COL_NAME,
+    add_stage_hook,
+    calculate_hourly_stats,
+    clean_data,
+    export_stem,
+    open_export,
+    plot_hourly_stats,
+    read_exported_dexcom_values,
+    remove_stage_hook,
+)
+from synthetic_export import SCALES, write_synthetic_exports
+
+COMPRESSIONS = ['gzip', 'zstd', 'zip']
+STAGES = ['read_exported_dexcom_values', 'clean_data', 'calculate_hourly_stats', 'plot_hourly_stats']
+DEFAULT_DATA_DIR = os.path.join(tempfile.gettempdir(), 'dv-bench')
+
+def synthetic_raw_readings(rows, seed=0):
+    """
+    Generate raw (uncleaned) readings as they come out of the csv reader:
+    5-minute timestamps and glucose values as strings, with some "Low",
+    "High" and empty values in between
+    """
+    rng = np.random.default_rng(seed)
+
+    timestamps = (np.datetime64('2015-01-01T00:00:00') + np.arange(rows) * 300).astype(str)
+    values = rng.integers(40, 400, rows).astype(str).astype(object)
+    special = rng.random(rows)
+    values[special < 0.01] = 'Low'
+    values[(special >= 0.01) & (special < 0.02)] = 'High'
+    values[(special >= 0.02) & (special < 0.025)] = None
+
+    return pl.DataFrame({
+        TIME_COL_NAME: timestamps,
+        VALUE_COL_NAME: pl.Series(values, dtype=pl.String)
+    })
+
+def best_time(function, repeat):
+    """
+    Best wall time of several runs of function, in seconds
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def bench_clean_data(rows, repeat):
+    """
+    Measure the clean_data throughput in rows per second
+    """
+    df = synthetic_raw_readings(rows)
+    seconds = best_time(lambda: clean_data(df), repeat)
+    print(f'clean_data: {rows} rows in {seconds:.3f} s, {rows / seconds / 1e6:.1f}M rows/s')
+
+def bench_pipeline(paths, repeat, output_dir):
+    """
+    Run every stage of the pipeline on each export, measuring it through the
+    stage hooks of plot.py. The times are the best of several runs summed
+    over the exports, the memory is the largest rise in resident memory seen
+    during a stage of a single export.
+    """
+    results = {stage: {'seconds': 0.0, 'cpu_seconds': 0.0, 'peak_memory_mb': 0.0} for stage in STAGES}
+    rows = 0
+
+    for path in paths:
+        best = {}
+        for _ in range(repeat):
+            timings = []
+            add_stage_hook(timings.append)
+            try:
+                df = read_exported_dexcom_values(path)
+                hourly_stats = calculate_hourly_stats(clean_data(df))
+                plot_hourly_stats(hourly_stats, os.path.join(output_dir, 'plot.png'))
+            finally:
+                remove_stage_hook(timings.append)
+            for timing in timings:
+                if timing.name not in best or timing.wall_seconds < best[timing.name].wall_seconds:
+                    best[timing.name] = timing
+                increase = (timing.peak_rss - timing.start_rss) / 1024 / 1024
+                results[timing.name]['peak_memory_mb'] = max(results[timing.name]['peak_memory_mb'], increase)
+        for stage in STAGES:
+            results[stage]['seconds'] += best[stage].wall_seconds
+            results[stage]['cpu_seconds'] += best[stage].cpu_seconds
+        rows += best['read_exported_dexcom_values'].rows
+
+    return {'files': len(paths), 'rows': rows, 'stages': results}
+
+def compress_export(path, compression, directory):
+    """
+    Write a compressed copy of an export into directory. Returns the path of
+    the copy and the path to read the export from, which differ for zip
+    archives.
+    """
+    stem = export_stem(path)
+    if compression == 'zip':
+        target = os.path.join(directory, f'{stem}.zip')
+        with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.write(path, f'{stem}.csv')
+        return target, f'{target}/{stem}.csv'
+
+    if compression == 'zstd':
+        import zstandard
+        target = os.path.join(directory, f'{stem}.csv.zst')
+        with open(path, 'rb') as source, open(target, 'wb') as f, zstandard.ZstdCompressor().stream_writer(f) as z:
+            shutil.copyfileobj(source, z, 1024 * 1024)
+    else:
+        target = os.path.join(directory, f'{stem}.csv.gz')
+        with open(path, 'rb') as source, gzip.open(target, 'wb') as z:
+            shutil.copyfileobj(source, z, 1024 * 1024)
+    return target, target
+
+def unpack_export(path, target):
+    """
+    Decompress an export to a plain csv file at target, as it had to be
+    done before compressed exports could be read directly
+    """
+    if path.endswith('.gz'):
+        source = gzip.open(path)
+    elif path.endswith('.zst'):
+        import zstandard
+        source = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    else:
+        source = open_export(path)
+    with source, open(target, 'wb') as f:
+        shutil.copyfileobj(source, f, 1024 * 1024)
+
+def streaming_hourly_stats(path):
+    """
+    The hourly stats of an export, read with a streaming query
+    """
+    return calculate_hourly_stats(clean_data(read_exported_dexcom_values(path, lazy=True))).collect(engine='streaming')
+
+def bench_compression(paths, repeat, work_dir):
+    """
+    Compare reading compressed exports directly with unpacking them to disk
+    first and reading the csv. The I/O is the number of bytes read and
+    written: the compressed file when it is read directly, plus writing and
+    reading the unpacked csv otherwise.
+    """
+    results = {}
+    for compression in COMPRESSIONS:
+        if compression == 'zstd':
+            try:
+                import zstandard  # noqa: F401
+            except ImportError:
+                print('zstd: skipped, the zstandard package is not installed')
+                continue
+
+        result = {'direct_seconds': 0.0, 'unpack_seconds': 0.0, 'direct_io_mb': 0.0, 'unpack_io_mb': 0.0}
+        for path in paths:
+            compressed, read_path = compress_export(path, compression, work_dir)
+            unpacked = os.path.join(work_dir, 'unpacked.csv')
+
+            def unpack_and_read():
+                unpack_export(read_path, unpacked)
+                streaming_hourly_stats(unpacked)
+
+            result['direct_seconds'] += best_time(lambda: streaming_hourly_stats(read_path), repeat)
+            result['unpack_seconds'] += best_time(unpack_and_read, repeat)
+            compressed_size, size = os.path.getsize(compressed), os.path.getsize(path)
+            result['direct_io_mb'] += compressed_size / 1024 / 1024
+            result['unpack_io_mb'] += (compressed_size + 2 * size) / 1024 / 1024
+            os.remove(compressed)
+            os.remove(unpacked)
+
+        results[compression] = result
+        print(f"{compression}: {result['direct_seconds']:.3f} s, {result['direct_io_mb']:.1f} MB I/O directly, "
+              f"{result['unpack_seconds']:.3f} s, {result['unpack_io_mb']:.1f} MB I/O unpacked first")
+    return results
+
+def git_commit():
+    """
+    The commit of the working tree, if it is a git checkout
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results, baseline=None):
+    """
+    Print the results as a table, with the change relative to the baseline
+    results if given
+    """
+    for scale, result in results['scales'].items():
+        print(f"{scale}: {result['files']} file(s), {result['rows']} rows")
+        for stage, measured in result['stages'].items():
+            line = (f"  {stage:<28} {measured['seconds']:9.3f} s {measured.get('cpu_seconds', 0):9.3f} s cpu "
+                    f"{measured['peak_memory_mb']:9.1f} MB")
+            before = (baseline or {}).get('scales', {}).get(scale, {}).get('stages', {}).get(stage)
+            if before and before['seconds'] > 0:
+                line += f"   {measured['seconds'] / before['seconds']:6.2f}x time vs {baseline.get('commit')}"
+            print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the glucose plot pipeline.')
+    parser.add_argument('--scales', nargs='+', choices=SCALES, default=['month', 'year'],
+                        help='Sizes of the synthetic exports to benchmark (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the best one is reported (default: %(default)s)')
+    parser.add_argument('--data-dir', type=str, default=DEFAULT_DATA_DIR,
+                        help='Directory the synthetic exports are generated in and reused from (default: %(default)s)')
+    parser.add_argument('--output', type=str, metavar='JSON', help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=str, metavar='JSON', help='Compare the results to an earlier JSON file')
+    parser.add_argument('--compression', action='store_true',
+                        help='Only compare reading compressed exports directly with unpacking them first')
+    parser.add_argument('--clean-data-rows', type=int, metavar='ROWS',
+                        help='Only run the clean_data micro-benchmark on this many synthetic readings')
+    args = parser.parse_args()
+
+    if args.clean_data_rows:
+        bench_clean_data(args.clean_data_rows, args.repeat)
+        return
+
+    if args.compression:
+        with tempfile.TemporaryDirectory() as work_dir:
+            for scale in args.scales:
+                print(f'{scale}:')
+                bench_compression(write_synthetic_exports(args.data_dir, scale), args.repeat, work_dir)
+        return
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'polars': pl.__version__,
+        'scales': {},
+    }
+    with tempfile.TemporaryDirectory() as output_dir:
+        for scale in args.scales:
+            paths = write_synthetic_exports(args.data_dir, scale)
+            results['scales'][scale] = bench_pipeline(paths, args.repeat, output_dir)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
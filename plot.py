@@ -1,123 +1,2026 @@
 #!/usr/bin/env python3
 
 import argparse
+import cProfile
+import ctypes
+import ctypes.util
+import csv
+import functools
+import glob
+import hashlib
+import io
+import json
+import os
+import select
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
 import polars as pl
-import matplotlib.pyplot as plt
 import numpy as np
-from scipy.interpolate import make_interp_spline
 
-def read_exported_dexcom_values(file_path):
+TIME_COL_NAME = 'Timestamp (YYYY-MM-DDThh:mm:ss)'
+VALUE_COL_NAME = 'Glucose Value (mg/dL)'
+EVENT_TYPE_COL_NAME = 'Event Type'
+CLARITY_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Values that the "Low" and "High" readings, below and above the 40-400 mg/dL
+# range of the sensor, are cleaned to. "High" readings are only kept for the
+# AGP metrics, see clean_data
+LOW_VALUE = 30
+HIGH_VALUE = 401
+
+# Suffixes of export files. Compressed exports are decompressed by polars
+# while they are read, exports in zip archives by read_zip_member
+EXPORT_SUFFIXES = ('.csv', '.csv.gz', '.csv.zst')
+ZIP_CHUNK_SIZE = 16 * 1024 * 1024
+TRANSMITTER_ID_COL_NAME = 'Transmitter ID'
+TRANSMITTER_TIME_COL_NAME = 'Transmitter Time (Long Integer)'
+# Number of times a reading appeared in overlapping exports
+COPIES_COL_NAME = 'Copies'
+# Optional key of the patient (or other source) of each reading, so that the
+# readings of many exports can be processed together in one frame
+PATIENT_COL_NAME = 'Patient'
+# Interval of the CGM readings, which resample_readings aligns them to, and
+# the column flagging the slots of that grid without a measured reading
+READING_INTERVAL = timedelta(minutes=5)
+GAP_COL_NAME = 'Gap'
+
+# Columns of a Clarity export in their order, with the types they are read
+# as, so the csv reader infers nothing. The glucose values stay strings for
+# the "Low"/"High" readings, and so do the timestamps: clean_data parses them
+# with their fixed format, which is several times faster than the datetime
+# parsing of the csv reader
+CLARITY_SCHEMA = {
+    'Index': pl.Int64,
+    TIME_COL_NAME: pl.String,
+    EVENT_TYPE_COL_NAME: pl.String,
+    'Event Subtype': pl.String,
+    'Patient Info': pl.String,
+    'Device Info': pl.String,
+    'Source Device ID': pl.String,
+    VALUE_COL_NAME: pl.String,
+    'Insulin Value (u)': pl.Float64,
+    'Carb Value (grams)': pl.Float64,
+    'Duration (hh:mm:ss)': pl.String,
+    'Glucose Rate of Change (mg/dL/min)': pl.Float64,
+    TRANSMITTER_TIME_COL_NAME: pl.Int64,
+    TRANSMITTER_ID_COL_NAME: pl.String,
+}
+
+# Bump when clean_data changes, so that stale cache entries are not used
+CACHE_VERSION = 3
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'dv')
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+# Columns and partitions of the Parquet store of readings, see append_to_store
+STORE_SCHEMA = {TIME_COL_NAME: pl.Datetime('us'), VALUE_COL_NAME: pl.Int32}
+STORE_PARTITIONS = {PATIENT_COL_NAME: pl.String, 'Year': pl.Int32, 'Month': pl.Int32}
+# A week of readings, 5 minutes apart
+STORE_ROW_GROUP_SIZE = 7 * 24 * 12
+
+# Seconds without changes before the exports that landed in a watched
+# directory are plotted, and between checks when polling for changes
+WATCH_DEBOUNCE = 0.2
+WATCH_POLL_INTERVAL = 1.0
+
+# Largest export accepted by the HTTP server, in bytes
+MAX_UPLOAD_SIZE = 512 * 1024 * 1024
+# Seconds a rejected request is drained for before its connection is closed
+REJECT_DRAIN_TIMEOUT = 1.0
+
+PERCENTILES = {
+    '5th Percentile': 0.05,
+    '25th Percentile': 0.25,
+    '75th Percentile': 0.75,
+    '95th Percentile': 0.95,
+}
+
+@dataclass(frozen=True)
+class StageTiming:
+    """
+    Measurements of one run of a pipeline stage, as passed to stage hooks.
+
+    peak_rss is the highest resident memory of the process seen while the
+    stage ran and start_rss the resident memory when it started, in bytes.
+    rows is the number of rows of the result if it is a data frame, and
+    profile the cProfile profile of the stage if a hook asked for it.
+    """
+    name: str
+    wall_seconds: float
+    cpu_seconds: float
+    start_rss: int
+    peak_rss: int
+    rows: int | None
+    profile: cProfile.Profile | None = None
+
+_stage_hooks = []
+_active_stage = threading.local()
+
+def add_stage_hook(hook, cprofile=False):
+    """
+    Call hook with a StageTiming after every pipeline stage (reading,
+    cleaning, calculating the stats, plotting, ...). With cprofile=True the
+    stages are also run under cProfile. Stages called from within other
+    stages are reported as part of the outer stage.
+    """
+    _stage_hooks.append((hook, cprofile))
+
+def remove_stage_hook(hook):
+    """
+    Stop calling a hook added with add_stage_hook
+    """
+    _stage_hooks[:] = [(h, c) for h, c in _stage_hooks if h != hook]
+
+def resident_memory():
+    """
+    Resident memory of this process in bytes (Linux only, 0 elsewhere)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return 0
+
+class PeakMemory:
+    """
+    Context manager that samples the resident memory in a background thread
+    and records the highest value
+    """
+    def __init__(self, interval=0.001):
+        self.interval = interval
+
+    def __enter__(self):
+        self.start = self.peak = resident_memory()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.done.set()
+        self.thread.join()
+        self.peak = max(self.peak, resident_memory())
+
+    def sample(self):
+        while not self.done.wait(self.interval):
+            self.peak = max(self.peak, resident_memory())
+
+def stage(function):
+    """
+    Mark a function as a pipeline stage, whose runs are reported to the stage
+    hooks. Without hooks the function is called directly.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _stage_hooks or getattr(_active_stage, 'name', None):
+            return function(*args, **kwargs)
+
+        profile = cProfile.Profile() if any(c for _, c in _stage_hooks) else None
+        _active_stage.name = function.__name__
+        try:
+            with PeakMemory() as memory:
+                wall, cpu = time.perf_counter(), time.process_time()
+                if profile:
+                    result = profile.runcall(function, *args, **kwargs)
+                else:
+                    result = function(*args, **kwargs)
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        finally:
+            _active_stage.name = None
+
+        rows = result.height if isinstance(result, pl.DataFrame) else None
+        timing = StageTiming(function.__name__, wall, cpu, memory.start, memory.peak, rows, profile)
+        for hook, _ in list(_stage_hooks):
+            hook(timing)
+        return result
+
+    return wrapper
+
+def print_stage_timings(timings, file=sys.stderr):
+    """
+    Print stage timings as a table
+    """
+    print(f"{'stage':<28} {'wall s':>9} {'cpu s':>9} {'peak rss MB':>12} {'rows':>10}", file=file)
+    for t in timings:
+        rows = '' if t.rows is None else t.rows
+        print(f'{t.name:<28} {t.wall_seconds:9.3f} {t.cpu_seconds:9.3f} {t.peak_rss / 1024 / 1024:12.1f} {rows:>10}',
+              file=file)
+
+def write_stage_timings(timings, path):
+    """
+    Write stage timings as a JSON list
+    """
+    with open(path, 'w') as f:
+        json.dump([{
+            'stage': t.name,
+            'wall_seconds': t.wall_seconds,
+            'cpu_seconds': t.cpu_seconds,
+            'start_rss_bytes': t.start_rss,
+            'peak_rss_bytes': t.peak_rss,
+            'rows': t.rows,
+        } for t in timings], f, indent=2)
+
+@stage
+def read_exported_dexcom_values(file_path, lazy=False, patient=None, start=None, end=None):
     """
     Read the DexCom csv export file
+
+    Only the EGV rows and the timestamp and glucose value columns are kept,
+    so the patient and device metadata rows at the top are skipped. Both the
+    projection and the filter are pushed down into the csv reader, so the
+    remaining columns are never materialized. With lazy=True a LazyFrame is
+    returned instead. The export is read with CLARITY_SCHEMA, see
+    scan_export.
+
+    With a patient key, e.g. the file name, every reading is tagged with it
+    in the Patient column, which is kept by clean_data and grouped by in
+    calculate_hourly_stats.
+
+    A list of file paths is read as overlapping exports of the same patient,
+    see read_overlapping_exports.
+
+    Exports compressed with gzip or zstd (.csv.gz, .csv.zst) are decompressed
+    while they are read, and exports inside of zip archives are read from
+    <archive>.zip/<member> paths, see read_zip_member.
+
+    With start and/or end only the rows from start (inclusive) to end
+    (exclusive) are kept. The timestamps are ISO 8601 strings, which sort
+    like the times they stand for, so the rows are filtered before the
+    timestamps are parsed, and lazily while the csv is read.
+    """
+    # the query stays lazy until the filters are added, so that they are
+    # pushed down into the csv reader for eager reads too
+    if isinstance(file_path, (list, tuple)):
+        df = read_overlapping_exports(file_path, lazy=True)
+    else:
+        df = scan_egv_rows(file_path, [TIME_COL_NAME, VALUE_COL_NAME])
+
+    if start is not None:
+        df = df.filter(pl.col(TIME_COL_NAME) >= start.strftime(CLARITY_TIME_FORMAT))
+    if end is not None:
+        df = df.filter(pl.col(TIME_COL_NAME) < end.strftime(CLARITY_TIME_FORMAT))
+    if patient is not None:
+        df = with_patient(df, patient)
+
+    return df if lazy else df.collect()
+
+def scan_egv_rows(file_path, columns):
+    """
+    Lazily read the columns of the EGV rows of an export, which may be
+    inside of a zip archive (see read_zip_member)
+    """
+    if split_zip_member(file_path) is not None:
+        return read_zip_member(file_path, lazy=True, columns=columns)
+    return scan_export(file_path).filter(pl.col(EVENT_TYPE_COL_NAME) == 'EGV').select(columns)
+
+def scan_export(file_path):
+    """
+    Lazily read all columns of an export, or of an uploaded export given as
+    a binary file object, with the types of CLARITY_SCHEMA. The layout of
+    the export is checked first, see check_export_layout.
+    """
+    check_export_layout(export_columns(file_path), file_path)
+    return pl.scan_csv(file_path, schema=CLARITY_SCHEMA)
+
+def export_columns(file_path):
+    """
+    The column names in the header of an export, without the byte order mark
+    that Clarity writes before the first one
+    """
+    zip_member = split_zip_member(file_path) if isinstance(file_path, (str, os.PathLike)) else None
+    if zip_member is None:
+        # only the header is parsed, as no types are inferred
+        columns = pl.scan_csv(file_path, infer_schema=False).collect_schema().names()
+        if not isinstance(file_path, (str, os.PathLike)):
+            file_path.seek(0)
+        return columns
+
+    with open_export(file_path) as f:
+        return next(csv.reader([f.readline().decode('utf-8-sig')]), [])
+
+def check_export_layout(columns, file_path):
+    """
+    Check that the columns of an export are the ones of CLARITY_SCHEMA, in
+    the same order. Exports in another layout, e.g. from a newer version of
+    Clarity or with mmol/L values, raise a ValueError that names the missing
+    and unexpected columns instead of being read with the wrong types.
+    """
+    expected = list(CLARITY_SCHEMA)
+    if columns == expected:
+        return
+
+    missing = [column for column in expected if column not in columns]
+    unexpected = [column for column in columns if column not in CLARITY_SCHEMA]
+    problems = []
+    if missing:
+        problems.append(f"missing columns {', '.join(map(repr, missing))}")
+    if unexpected:
+        problems.append(f"unexpected columns {', '.join(map(repr, unexpected))}")
+    if not problems:
+        problems.append('the columns are in a different order')
+
+    name = file_path if isinstance(file_path, (str, os.PathLike)) else 'the upload'
+    raise ValueError(f"{name} is not a Clarity export in the known layout: {'; '.join(problems)}")
+
+def read_overlapping_exports(file_paths, lazy=False):
+    """
+    Read the EGV rows of several exports that may cover overlapping date
+    ranges, keeping each reading only once (see drop_duplicate_readings).
+    The readings have the timestamp, glucose value and Copies columns.
+    """
+    columns = [TIME_COL_NAME, VALUE_COL_NAME, TRANSMITTER_ID_COL_NAME, TRANSMITTER_TIME_COL_NAME]
+
+    df = drop_duplicate_readings(pl.concat([scan_egv_rows(file_path, columns) for file_path in file_paths]))
+    return df if lazy else df.collect()
+
+def drop_duplicate_readings(df):
+    """
+    Keep one copy of each reading, with the number of copies that were seen
+    in the Copies column.
+
+    A reading is identified by its transmitter and transmitter time, which
+    stay the same in every export, or by its timestamp where those are
+    missing. The duplicates are found with a hash based group by, which is
+    linear in the number of readings and runs on the streaming engine.
+    """
+    key = pl.coalesce(
+        pl.concat_str([TRANSMITTER_ID_COL_NAME, TRANSMITTER_TIME_COL_NAME], separator='/'),
+        pl.col(TIME_COL_NAME)
+    )
+    return df.group_by(key.alias('Reading')).agg([
+        pl.col(TIME_COL_NAME).first(),
+        pl.col(VALUE_COL_NAME).first(),
+        pl.len().alias(COPIES_COL_NAME)
+    ]).drop('Reading')
+
+def count_duplicate_readings(df):
+    """
+    Number of readings dropped by drop_duplicate_readings, as a single value
+    frame of the same kind as df
+    """
+    return df.select((pl.col(COPIES_COL_NAME) - 1).sum().alias('Duplicates'))
+
+def is_export_file(name):
+    """
+    Check whether a file name is that of an export, compressed or not
+    """
+    return name.endswith(EXPORT_SUFFIXES)
+
+def is_export_source(name):
+    """
+    Check whether a file name is that of an export or of a zip archive of
+    exports, the files that are read from directories and watched
+    """
+    return is_export_file(name) or name.endswith('.zip')
+
+def source_exports(path):
+    """
+    The exports in an export source file: the file itself, or the exports in
+    a zip archive as <archive>.zip/<member> paths
+    """
+    return zip_members(path) if path.endswith('.zip') else [path]
+
+def export_stem(file_path):
+    """
+    Name of an export without its directory and its .csv(.gz/.zst) suffix
+    """
+    name = os.path.basename(file_path)
+    for suffix in EXPORT_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+def export_files(directory):
+    """
+    The exports in a directory, with the exports inside of zip archives as
+    <archive>.zip/<member> paths
+    """
+    file_paths = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if is_export_source(name) and os.path.isfile(path):
+            file_paths.extend(source_exports(path))
+    return file_paths
+
+def zip_members(zip_path):
+    """
+    The csv exports inside of a zip archive, as <archive>.zip/<member> paths
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        return [f'{zip_path}/{name}' for name in archive.namelist() if name.endswith('.csv')]
+
+def split_zip_member(file_path):
+    """
+    Split an <archive>.zip/<member> path into the archive and the member,
+    or return None for other paths
+    """
+    archive, separator, member = str(file_path).partition('.zip/')
+    if separator and os.path.isfile(archive + '.zip'):
+        return archive + '.zip', member
+    return None
+
+def open_export(file_path):
+    """
+    Open an export, or an export inside of a zip archive, for reading bytes
+    """
+    zip_member = split_zip_member(file_path)
+    if zip_member is None:
+        return open(file_path, 'rb')
+
+    archive = zipfile.ZipFile(zip_member[0])
+    try:
+        member = archive.open(zip_member[1])
+    except BaseException:
+        archive.close()
+        raise
+    # the member stays readable after the archive is closed, the underlying
+    # file is only closed once the member is closed too
+    archive.close()
+    return member
+
+def read_zip_member(file_path, lazy=False, columns=(TIME_COL_NAME, VALUE_COL_NAME)):
     """
-    return pl.read_csv(file_path)
+    Read the EGV rows of an export inside of a zip archive, decompressing and
+    parsing it in chunks of about ZIP_CHUNK_SIZE bytes. Only the given
+    columns of each chunk are kept, the timestamp and glucose value by
+    default, so neither the archive is unpacked to disk nor the whole export
+    is held in memory.
 
-def clean_data(df):
+    Chunks are split at line ends, which works because Clarity exports have
+    no line breaks within fields.
+    """
+    columns = list(columns)
+
+    def egv_rows(data):
+        return (pl.read_csv(data, columns=[EVENT_TYPE_COL_NAME, *columns], schema=CLARITY_SCHEMA)
+                .filter(pl.col(EVENT_TYPE_COL_NAME) == 'EGV')
+                .select(columns))
+
+    with open_export(file_path) as f:
+        header = f.readline()
+        check_export_layout(next(csv.reader([header.decode('utf-8-sig')]), []), file_path)
+        chunks = []
+        while chunk := f.read(ZIP_CHUNK_SIZE):
+            chunks.append(egv_rows(header + chunk + f.readline()))
+
+    df = pl.concat(chunks) if chunks else egv_rows(header)
+    return df.lazy() if lazy else df
+
+def with_patient(df, patient):
+    """
+    Tag every reading with the patient key
+    """
+    return df.with_columns(pl.lit(patient, dtype=pl.String).alias(PATIENT_COL_NAME))
+
+def has_patient(df):
+    """
+    Check whether the readings are tagged with a patient key
+    """
+    return PATIENT_COL_NAME in df.collect_schema().names()
+
+def is_empty(df):
+    """
+    Check whether an eager data frame is empty. Lazy frames are never
+    considered empty, as that can only be known after they are collected.
+    """
+    return isinstance(df, pl.DataFrame) and df.is_empty()
+
+@stage
+def clean_data(df, high_value=None):
     """
     Clean the empty values
+
+    Accepts both a DataFrame and a LazyFrame and returns the same kind. The
+    Patient column is kept if there is one. "High" readings are dropped,
+    unless a high_value (HIGH_VALUE for the AGP metrics) is given for them.
     """
 
     # return empty data frame if the input is empty
-    if df.is_empty():
+    if is_empty(df):
         return df
 
-    # Select only the timestamp and glucose value columns
-    df = df.select(['Timestamp (YYYY-MM-DDThh:mm:ss)', 'Glucose Value (mg/dL)'])
+    # Convert "Low" to 30, the other values to integers and the timestamp to
+    # datetime in one projection. The timestamps are (nearly) all distinct, so
+    # caching their parsed values would only cost time
+    value = pl.when(pl.col(VALUE_COL_NAME) == "Low").then(pl.lit(LOW_VALUE, dtype=pl.Int32))
+    if high_value is not None:
+        value = value.when(pl.col(VALUE_COL_NAME) == "High").then(pl.lit(high_value, dtype=pl.Int32))
+    value = value.otherwise(pl.col(VALUE_COL_NAME).cast(pl.Int32, strict=False)).alias(VALUE_COL_NAME)
+    timestamp = pl.col(TIME_COL_NAME).str.strptime(pl.Datetime, format=CLARITY_TIME_FORMAT, strict=False, cache=False)
+
+    # Drop rows with missing, non-numerical or negative values and missing or
+    # unparseable timestamps in one predicate (comparisons with null are false)
+    patient = [PATIENT_COL_NAME] if has_patient(df) else []
+    query = df.lazy().select([*patient, timestamp, value]).filter(
+        (pl.col(VALUE_COL_NAME) >= 0) & pl.col(TIME_COL_NAME).is_not_null()
+    )
+
+    return query if isinstance(df, pl.LazyFrame) else query.collect()
+
+@stage
+def read_cleaned_readings(file_path, cache_dir=DEFAULT_CACHE_DIR, max_cache_size=DEFAULT_CACHE_SIZE, evict=True):
+    """
+    Read and clean the DexCom csv export file through an on-disk cache.
+
+    The cleaned readings are stored as Parquet files named after a hash of
+    the file contents, so later reads of the same export skip the csv parsing
+    and cleaning. Returns a LazyFrame that scans the cached file. When the
+    cache grows beyond max_cache_size bytes, the least recently used entries
+    are removed, except for the one that is returned, even if it alone is
+    larger than max_cache_size. With evict=False nothing is removed, so the
+    scans of several exports stay valid until a query over all of them is
+    collected and evict_cache is called.
+    """
+    cache_path = os.path.join(cache_dir, f'{file_content_hash(file_path)}.parquet')
+
+    if os.path.exists(cache_path):
+        # the modification time tracks the last use for the LRU eviction
+        os.utime(cache_path)
+    else:
+        os.makedirs(cache_dir, exist_ok=True)
+        # a temporary file of its own for every writer, as the same export
+        # can be read by several threads or processes at once
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        os.close(fd)
+        try:
+            clean_data(read_exported_dexcom_values(file_path, lazy=True)).sink_parquet(tmp_path)
+            if os.path.exists(cache_path):
+                # written concurrently, which makes this a cache hit
+                os.remove(tmp_path)
+                os.utime(cache_path)
+            else:
+                os.replace(tmp_path, cache_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if evict:
+            evict_cache(cache_dir, max_cache_size, keep=cache_path)
+
+    return pl.scan_parquet(cache_path)
+
+def file_content_hash(file_path):
+    """
+    Hash the contents of a file, together with the cache version
+    """
+    digest = hashlib.sha256(f'v{CACHE_VERSION}'.encode())
+    with open_export(file_path) as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-    # Replace "Low" with 0 and drop rows with missing or non-numerical values
-    df = df.with_columns([
-        pl.col('Glucose Value (mg/dL)').replace("Low", 30).cast(pl.Int32, strict=False)
-    ]).drop_nulls()
+def evict_cache(cache_dir, max_cache_size, keep=None):
+    """
+    Remove the least recently used cache entries until the cache fits in
+    max_cache_size bytes, or only the entry at keep is left
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.parquet'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # removed by a concurrent run
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
 
-    # Replace negative values with null and drop them
-    df = df.with_columns([
-        pl.when(pl.col("Glucose Value (mg/dL)") < 0)
-         .then(None)
-         .otherwise(pl.col("Glucose Value (mg/dL)")) # keep original value
-         .name.keep()
-    ]).drop_nulls()
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_cache_size:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
 
+@stage
+def append_to_store(df, store_dir, patient):
+    """
+    Append cleaned readings of a patient to the Parquet store in store_dir.
 
-    # Convert timestamp to datetime
-    df = df.with_columns([
-        pl.col('Timestamp (YYYY-MM-DDThh:mm:ss)').str.strptime(pl.Datetime, format='%Y-%m-%dT%H:%M:%S', strict=False)
-    ]).drop_nulls()
+    The store is a Hive partitioned dataset with a directory per patient,
+    year and month, e.g. Patient=jane/Year=2024/Month=6/data.parquet. Only
+    the months that get new readings are rewritten, sorted by time, so that
+    the statistics of their row groups let scans skip the weeks outside of
+    a date range. Readings with the same time and value as one that is
+    already in the store are kept only once, so overlapping exports can be
+    appended again.
+    """
+    if isinstance(df, pl.LazyFrame):
+        df = df.collect()
 
+    df = df.select([TIME_COL_NAME, VALUE_COL_NAME]).with_columns([
+        pl.col(TIME_COL_NAME).dt.year().alias('Year'),
+        pl.col(TIME_COL_NAME).dt.month().alias('Month')
+    ])
+    for (year, month), readings in df.partition_by(['Year', 'Month'], as_dict=True).items():
+        directory = os.path.join(store_dir, f'{PATIENT_COL_NAME}={urllib.parse.quote(patient, safe="")}',
+                                 f'Year={year}', f'Month={month}')
+        path = os.path.join(directory, 'data.parquet')
+        readings = readings.select([TIME_COL_NAME, VALUE_COL_NAME])
+        if os.path.exists(path):
+            readings = pl.concat([pl.read_parquet(path, hive_partitioning=False), readings])
+
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        readings.unique().sort(TIME_COL_NAME).write_parquet(
+            tmp_path, statistics=True, row_group_size=STORE_ROW_GROUP_SIZE)
+        os.replace(tmp_path, path)
+
+def scan_store(store_dir):
+    """
+    Scan all readings in the Parquet store, with the Patient, Year and Month
+    of their partition as columns. Filter the scan with filter_readings to
+    only read the partitions that are needed.
+    """
+    # with the schema given up front no file is opened to infer it
+    return pl.scan_parquet(os.path.join(store_dir, '**', '*.parquet'), schema=STORE_SCHEMA,
+                           hive_partitioning=True, hive_schema=STORE_PARTITIONS)
+
+def filter_readings(df, start=None, end=None, patient=None, last=None):
+    """
+    Keep the readings of the patient from start (inclusive) to end
+    (exclusive), each filter only if it is given. With last, a timedelta,
+    only the readings within last of the newest remaining reading are kept,
+    e.g. the last 14 days of an export, or of each patient's readings.
+
+    On a scan of the store the filters are pushed down into the scan: only
+    the partitions of the patient and of the months in the range are read,
+    and row groups outside of the range are skipped by their statistics.
+    """
+    names = df.collect_schema().names()
+    month = pl.col('Year') * 12 + pl.col('Month') - 1 if 'Year' in names and 'Month' in names else None
+
+    predicates = []
+    if patient is not None:
+        predicates.append(pl.col(PATIENT_COL_NAME) == patient)
+    if start is not None:
+        predicates.append(pl.col(TIME_COL_NAME) >= start)
+        if month is not None:
+            predicates.append(month >= start.year * 12 + start.month - 1)
+    if end is not None:
+        predicates.append(pl.col(TIME_COL_NAME) < end)
+        if month is not None:
+            predicates.append(month <= end.year * 12 + end.month - 1)
+
+    if predicates:
+        df = df.filter(pl.all_horizontal(predicates))
+    if last is not None:
+        newest = pl.col(TIME_COL_NAME).max()
+        if PATIENT_COL_NAME in names:
+            newest = newest.over(PATIENT_COL_NAME)
+        df = df.filter(pl.col(TIME_COL_NAME) > newest - last)
     return df
 
-def calculate_hourly_stats(df):
+@stage
+def resample_readings(df, max_gap=None):
+    """
+    Align the cleaned readings to a regular grid of READING_INTERVAL (5
+    minute) slots, from the first to the last reading of each patient. A
+    slot with several readings gets their rounded mean, and slots without a
+    reading, e.g. during sensor warm-ups and signal losses, get a null value
+    and are flagged in the Gap column.
+
+    With max_gap, a timedelta, gaps of at most that many missing minutes are
+    filled by linear interpolation between the readings around them. They
+    stay flagged as gaps, so calculate_hourly_stats counts only the measured
+    readings in its Coverage column.
+
+    Accepts both a DataFrame and a LazyFrame and returns the same kind. The
+    grid is built per patient and joined to the readings by their slot with
+    hash based group bys and joins, without sorting, so the time grows
+    linearly with the readings and the length of the grid.
+    """
+    if is_empty(df):
+        return df
+
+    patient = [PATIENT_COL_NAME] if has_patient(df) else []
+    readings = df.lazy().group_by([*patient, pl.col(TIME_COL_NAME).dt.truncate(READING_INTERVAL)]).agg(
+        pl.col(VALUE_COL_NAME).mean().round().cast(pl.Int32)
+    )
+
+    slots = pl.datetime_ranges(pl.col(TIME_COL_NAME).min(), pl.col(TIME_COL_NAME).max(), READING_INTERVAL)
+    grid = readings.group_by(patient).agg(slots) if patient else readings.select(slots)
+    query = grid.explode(TIME_COL_NAME).join(
+        readings, on=[*patient, TIME_COL_NAME], how='left', maintain_order='left'
+    ).with_columns(pl.col(VALUE_COL_NAME).is_null().alias(GAP_COL_NAME))
+
+    if max_gap:
+        # Every patient's slots start and end with a reading, so counting the
+        # readings numbers the gaps after them, and interpolating never
+        # crosses from one patient to the next
+        gap = pl.col(VALUE_COL_NAME).is_not_null().cum_sum()
+        short = pl.len().over(gap) - 1 <= max_gap // READING_INTERVAL
+        query = query.with_columns(
+            pl.when(pl.col(GAP_COL_NAME) & short)
+            .then(pl.col(VALUE_COL_NAME).interpolate().round().cast(pl.Int32))
+            .otherwise(pl.col(VALUE_COL_NAME))
+            .alias(VALUE_COL_NAME)
+        )
+
+    return query if isinstance(df, pl.LazyFrame) else query.collect()
+
+def has_gaps(df):
+    """
+    Check whether the readings were resampled, with their gaps flagged
+    """
+    return GAP_COL_NAME in df.collect_schema().names()
+
+@stage
+def calculate_hourly_stats(df, bin_minutes=60, start=None, end=None, patient=None, last=None):
     """
     Calculate the mean, 25th percentile, and 75th percentile glucose values for each hour.
+
+    With bin_minutes below 60 the day is split into bins of that many minutes
+    instead (e.g. 5, 15 or 30), identified by the Hour and Minute of their
+    start. The readings are assigned to their bin with integer arithmetic
+    and aggregated in a single pass, however many bins there are.
+
+    Accepts both a DataFrame and a LazyFrame and returns the same kind, so
+    the whole pipeline can stay a single lazy query until it is collected.
+    The lazy query only keeps per bin value counts, so it can also run on
+    the streaming engine in bounded memory. Data frames are counted into a
+    histogram with numpy, so no per bin sorting is needed.
+
+    Readings tagged with a Patient column are grouped by patient and bin in
+    the same pass, giving the stats of every patient in one table.
+
+    start, end, patient and last limit the stats to some of the readings,
+    see filter_readings. On a scan of the store only the needed partitions
+    are read.
+
+    Readings from resample_readings get a Coverage column, the share of the
+    5-minute slots of each bin that have a measured reading. Interpolated
+    readings count towards the stats but not towards the coverage.
     """
+    df = filter_readings(df, start, end, patient, last)
 
     # return empty data frame if the input is empty
-    if df.is_empty():
+    if is_empty(df):
         return df
 
-    # Extract hour from the timestamp
-    df = df.with_columns([
-        pl.col('Timestamp (YYYY-MM-DDThh:mm:ss)').dt.hour().alias('Hour')
+    if isinstance(df, pl.LazyFrame):
+        return hourly_stats_from_counts(hourly_value_counts(df, bin_minutes), bin_minutes)
+
+    # the dense histogram would have a row per patient and bin, the sparse
+    # value counts stay small however many patients there are, and they
+    # also count the slots of the resampled readings
+    if has_patient(df) or has_gaps(df):
+        return hourly_stats_from_counts(hourly_value_counts(df.lazy(), bin_minutes), bin_minutes).collect()
+
+    return hourly_stats_from_histogram(*hourly_histogram(df, bin_minutes), bin_minutes)
+
+def bins_per_day(bin_minutes):
+    """
+    Number of time bins in a day, checking that the bins divide an hour
+    """
+    if bin_minutes <= 0 or 60 % bin_minutes:
+        raise ValueError(f'bin_minutes must divide an hour, got {bin_minutes}')
+    return 24 * 60 // bin_minutes
+
+def time_bin(dtype, bin_minutes=60):
+    """
+    Expression for the index of the time of day bin of the timestamp column,
+    which has the given datetime dtype.
+
+    Naive timestamps are bucketed with integer arithmetic on the underlying
+    epoch values, which is several times faster than dt.hour() and dt.minute().
+    """
+    bins = bins_per_day(bin_minutes)
+    timestamp = pl.col(TIME_COL_NAME)
+
+    if dtype.time_zone is not None:
+        return (timestamp.dt.hour().cast(pl.Int64) * 60 + timestamp.dt.minute()) // bin_minutes
+
+    units_per_minute = {'ns': 60_000_000_000, 'us': 60_000_000, 'ms': 60_000}[dtype.time_unit]
+    return timestamp.to_physical() // (units_per_minute * bin_minutes) % bins
+
+def bin_start_columns(bins, bin_minutes):
+    """
+    Columns identifying bins by their start: only the Hour for hourly bins,
+    the Hour and the Minute for smaller ones
+    """
+    minutes = np.asarray(bins) * bin_minutes
+    columns = {'Hour': pl.Series(minutes // 60, dtype=pl.Int8)}
+    if bin_minutes < 60:
+        columns['Minute'] = pl.Series(minutes % 60, dtype=pl.Int8)
+    return columns
+
+def hourly_histogram(df, bin_minutes=60):
+    """
+    Build a bins x K matrix with the number of times each glucose value was
+    measured in each time of day bin (24 hours by default), in a single pass
+    over the data.
+
+    Returns the matrix and the glucose value of its first column.
+    """
+    bins = bins_per_day(bin_minutes)
+    df = df.select([TIME_COL_NAME, VALUE_COL_NAME]).drop_nulls()
+    keys = df.select(time_bin(df.schema[TIME_COL_NAME], bin_minutes)).to_series().to_numpy()
+    values = df[VALUE_COL_NAME].to_numpy().astype(np.int64, copy=False)
+
+    if values.size == 0:
+        return np.zeros((bins, 1), dtype=np.int64), 0
+
+    min_value = values.min()
+    size = values.max() - min_value + 1
+    counts = np.bincount(keys * size + (values - min_value), minlength=bins * size)
+
+    return counts.reshape(bins, size), min_value
+
+def hourly_stats_from_histogram(counts, min_value, bin_minutes=60):
+    """
+    Calculate the hourly stats from an hourly histogram.
+
+    The mean and the percentiles are exact. The percentiles use the same
+    "nearest" interpolation as polars' quantile, see hourly_stats_from_counts.
+    """
+    bins = np.flatnonzero(counts.sum(axis=1))
+    counts = counts[bins]
+    totals = counts.sum(axis=1)
+    values = np.arange(min_value, min_value + counts.shape[1])
+    cumulative = counts.cumsum(axis=1)
+
+    def percentile(q):
+        index = np.floor((totals - 1) * q + 0.5)
+        return values[np.argmax(cumulative > index[:, np.newaxis], axis=1)].astype(np.float64)
+
+    return pl.DataFrame({
+        **bin_start_columns(bins, bin_minutes),
+        'Mean Glucose Value': (counts @ values) / totals,
+        **{name: percentile(q) for name, q in PERCENTILES.items()}
+    })
+
+def hourly_value_counts(df, bin_minutes=60):
+    """
+    Count how often each glucose value was measured in each time of day bin,
+    per patient if the readings have a Patient column.
+
+    Glucose values are integers in a small range, so the result has at most a
+    few thousand rows per bin no matter how large the input is.
+
+    Resampled readings also get the number of Slots and of Measured readings
+    of each value, and their unfilled gaps are counted as a null value with
+    a Count of 0.
+    """
+    patient = [PATIENT_COL_NAME] if has_patient(df) else []
+    counts = [pl.len().alias('Count')]
+    if has_gaps(df):
+        counts = [
+            pl.col(VALUE_COL_NAME).count().alias('Count'),
+            pl.len().alias('Slots'),
+            pl.col(GAP_COL_NAME).not_().sum().alias('Measured'),
+        ]
+    return df.group_by([
+        *patient,
+        time_bin(df.collect_schema()[TIME_COL_NAME], bin_minutes).alias('Bin'),
+        VALUE_COL_NAME
+    ]).agg(counts)
+
+def hourly_stats_from_counts(counts, bin_minutes=60):
+    """
+    Calculate the hourly stats from the per bin value counts.
+
+    The percentiles are exact and use the same "nearest" interpolation as
+    polars' quantile: the value at index round((n - 1) * q) of the sorted
+    values, rounding halves up.
+    """
+    keys = [PATIENT_COL_NAME, 'Bin'] if has_patient(counts) else ['Bin']
+    counts = counts.sort([*keys, VALUE_COL_NAME]).with_columns([
+        pl.col('Count').cum_sum().over(keys).alias('Cumulative Count'),
+        pl.col('Count').sum().over(keys).alias('Total Count')
     ])
 
-    hourly_stats = df.group_by('Hour').agg([
-        pl.mean('Glucose Value (mg/dL)').alias('Mean Glucose Value'),
-        pl.col('Glucose Value (mg/dL)').quantile(0.05).alias('5th Percentile'),
-        pl.col('Glucose Value (mg/dL)').quantile(0.25).alias('25th Percentile'),
-        pl.col('Glucose Value (mg/dL)').quantile(0.75).alias('75th Percentile'),
-        pl.col('Glucose Value (mg/dL)').quantile(0.95).alias('95th Percentile')
-    ]).sort('Hour')
+    def percentile(q):
+        index = ((pl.col('Total Count') - 1) * q + 0.5).floor()
+        return pl.col(VALUE_COL_NAME).filter(pl.col('Cumulative Count') > index).first().cast(pl.Float64)
 
-    print(hourly_stats)
+    minute_of_day = pl.col('Bin') * bin_minutes
+    bin_start = [(minute_of_day // 60).cast(pl.Int8).alias('Hour')]
+    if bin_minutes < 60:
+        bin_start.append((minute_of_day % 60).cast(pl.Int8).alias('Minute'))
 
-    return hourly_stats
+    # the unfilled gaps of resampled readings sort first with a Count of 0,
+    # so they are never picked as a percentile and add nothing to the mean.
+    # Bins of nothing but gaps keep null stats and a Coverage of 0.
+    coverage = []
+    if 'Slots' in counts.collect_schema().names():
+        coverage = [(pl.col('Measured').sum() / pl.col('Slots').sum()).alias('Coverage')]
+    mean = (pl.col(VALUE_COL_NAME).cast(pl.Int64) * pl.col('Count')).sum() / pl.col('Count').sum()
+
+    return counts.group_by(keys).agg([
+        pl.when(pl.col('Count').sum() > 0).then(mean).alias('Mean Glucose Value'),
+        *[percentile(q).alias(name) for name, q in PERCENTILES.items()],
+        *coverage,
+    ]).sort(keys).select([*keys[:-1], *bin_start, pl.exclude(keys)])
+
+# Glucose ranges of the Ambulatory Glucose Profile, as (lower, upper) bounds
+# in mg/dL. The ranges are consecutive: every integer reading falls into
+# exactly one of them.
+AGP_RANGES = {
+    'very_low': (None, 54),
+    'low': (54, 70),
+    'in_range': (70, 181),
+    'high': (181, 251),
+    'very_high': (251, None),
+}
 
-def plot_hourly_stats(hourly_stats):
+@dataclass(frozen=True)
+class AgpMetrics:
+    """
+    The summary metrics of the Ambulatory Glucose Profile.
+
+    The time_* fields are the percentage of readings below 54 mg/dL, in
+    54-69, in the 70-180 target range, in 181-250 and above 250 mg/dL.
+    gmi is the Glucose Management Indicator (the estimated A1c) and
+    coefficient_of_variation the standard deviation relative to the mean,
+    both in percent. sensor_wear is the percentage of the expected 5 minute
+    readings between the first and the last reading that were recorded.
+    Without readings all metrics but readings are None. patient is None
+    for readings without a Patient column.
+    """
+    readings: int
+    mean: float | None
+    standard_deviation: float | None
+    coefficient_of_variation: float | None
+    gmi: float | None
+    sensor_wear: float | None
+    time_very_low: float | None
+    time_low: float | None
+    time_in_range: float | None
+    time_high: float | None
+    time_very_high: float | None
+    patient: str | None = None
+
+def agp_metric_expressions():
+    """
+    Aggregation expressions of the AGP metrics, which can be evaluated
+    together with other aggregations in a single select
+    """
+    value = pl.col(VALUE_COL_NAME)
+    timestamp = pl.col(TIME_COL_NAME)
+    readings = value.count()
+
+    def percentage_in(lower, upper):
+        within = pl.lit(True)
+        if lower is not None:
+            within = within & (value >= lower)
+        if upper is not None:
+            within = within & (value < upper)
+        return within.sum() * 100 / readings
+
+    expected_readings = (timestamp.max() - timestamp.min()).dt.total_seconds() / 300 + 1
+    return [
+        readings.alias('readings'),
+        value.mean().alias('mean'),
+        value.std().alias('standard_deviation'),
+        (value.std() * 100 / value.mean()).alias('coefficient_of_variation'),
+        (3.31 + 0.02392 * value.mean()).alias('gmi'),
+        pl.min_horizontal(readings * 100 / expected_readings, 100.0).alias('sensor_wear'),
+        *[percentage_in(lower, upper).alias(f'time_{name}') for name, (lower, upper) in AGP_RANGES.items()]
+    ]
+
+def agp_metrics_query(df):
+    """
+    Lazy query of the AGP metrics of cleaned readings, with one row per
+    patient (sorted by patient) if the readings have a Patient column
+    """
+    if has_patient(df):
+        return (df.lazy().group_by(PATIENT_COL_NAME).agg(agp_metric_expressions())
+                .sort(PATIENT_COL_NAME).rename({PATIENT_COL_NAME: 'patient'}))
+    return df.lazy().select(agp_metric_expressions())
+
+def agp_metrics_of(metrics):
+    """
+    The AgpMetrics of every row of the collected agp_metrics_query
+    """
+    return [
+        AgpMetrics(**row) if row['readings'] else AgpMetrics(0, *[None] * 10, patient=row.get('patient'))
+        for row in metrics.iter_rows(named=True)
+    ]
+
+@stage
+def calculate_agp_metrics(df, streaming=False):
+    """
+    Calculate the AGP metrics of cleaned readings in a single pass.
+
+    Accepts both a DataFrame and a LazyFrame. The metrics are plain
+    aggregations, so a lazy query can be collected on the streaming engine.
+    "High" readings only count towards the metrics if the readings were
+    cleaned with clean_data(df, HIGH_VALUE).
+
+    Returns a list of AgpMetrics: one per patient, sorted by patient, for
+    readings with a Patient column, otherwise only the metrics of all
+    readings.
+    """
+    if is_empty(df):
+        return [] if has_patient(df) else [AgpMetrics(0, *[None] * 10)]
+
+    return agp_metrics_of(agp_metrics_query(df).collect(engine='streaming' if streaming else 'auto'))
+
+@stage
+def calculate_hourly_stats_and_agp_metrics(df, bin_minutes=60, streaming=False):
+    """
+    Calculate the hourly stats and the AGP metrics of cleaned readings
+    together, returning both. The queries of a LazyFrame are collected at
+    once, so the readings are read and cleaned only once for both. "High"
+    readings kept by clean_data(df, HIGH_VALUE) are left out of the hourly
+    stats, which drop them like clean_data does by default.
+
+    A DataFrame is scanned twice, once for each. Counting its values once
+    for both takes longer than the histogram of calculate_hourly_stats and
+    the plain aggregations of calculate_agp_metrics together (0.050 s vs
+    0.043 s for ten years of readings).
+    """
+    readings = df.filter(pl.col(VALUE_COL_NAME) != HIGH_VALUE)
+    if not isinstance(df, pl.LazyFrame):
+        return calculate_hourly_stats(readings, bin_minutes), calculate_agp_metrics(df)
+
+    hourly_stats, metrics = pl.collect_all([calculate_hourly_stats(readings, bin_minutes), agp_metrics_query(df)],
+                                           engine='streaming' if streaming else 'auto')
+    return hourly_stats, agp_metrics_of(metrics)
+
+@dataclass(frozen=True)
+class HourlySummary:
+    """
+    A mergeable summary of glucose readings, from which the hourly stats can
+    be calculated without the readings themselves.
+
+    counts is the histogram (see hourly_histogram) of the time of day bins of
+    bin_minutes, with min_value as the glucose value of its first column, and
+    last_timestamp the time of the newest reading that was counted (None if
+    nothing was counted yet).
+    """
+    counts: np.ndarray
+    min_value: int
+    last_timestamp: datetime | None
+    bin_minutes: int = 60
+
+def summarize_readings(df, bin_minutes=60):
+    """
+    Summarize cleaned readings into an HourlySummary
+    """
+    if isinstance(df, pl.LazyFrame):
+        df = df.collect()
+
+    if df.is_empty():
+        return HourlySummary(np.zeros((bins_per_day(bin_minutes), 1), dtype=np.int64), 0, None, bin_minutes)
+
+    counts, min_value = hourly_histogram(df, bin_minutes)
+    return HourlySummary(counts, int(min_value), df[TIME_COL_NAME].max(), bin_minutes)
+
+def merge_hourly_summaries(first, second):
+    """
+    Merge two summaries into one, as if their readings were summarized together
+    """
+    if first.bin_minutes != second.bin_minutes:
+        raise ValueError(f'can not merge summaries of {first.bin_minutes} and {second.bin_minutes} minute bins')
+
+    low = min(first.min_value, second.min_value)
+    high = max(first.min_value + first.counts.shape[1], second.min_value + second.counts.shape[1])
+    counts = np.zeros((first.counts.shape[0], high - low), dtype=np.int64)
+    for summary in (first, second):
+        offset = summary.min_value - low
+        counts[:, offset:offset + summary.counts.shape[1]] += summary.counts
+
+    timestamps = [t for t in (first.last_timestamp, second.last_timestamp) if t is not None]
+    return HourlySummary(counts, low, max(timestamps, default=None), first.bin_minutes)
+
+@stage
+def update_hourly_summary(summary, df, bin_minutes=60):
+    """
+    Fold the readings that are newer than the newest reading in the summary
+    into it. Readings are expected to arrive in chronological order, as they
+    do with consecutive Clarity exports. Without a summary a new one with
+    bins of bin_minutes is started.
+
+    With a LazyFrame the filter is part of the query, so older readings are
+    dropped while the export is read.
+    """
+    if summary is None:
+        return summarize_readings(df, bin_minutes)
+
+    if summary.last_timestamp is not None and not is_empty(df):
+        df = df.filter(pl.col(TIME_COL_NAME) > summary.last_timestamp)
+
+    return merge_hourly_summaries(summary, summarize_readings(df, summary.bin_minutes))
+
+def save_hourly_summary(summary, path):
+    """
+    Save the summary as a numpy .npz file
+    """
+    last_timestamp = np.datetime64(summary.last_timestamp or 'NaT', 'us')
+    with open(path, 'wb') as f:
+        np.savez(f, counts=summary.counts, min_value=summary.min_value, last_timestamp=last_timestamp,
+                 bin_minutes=summary.bin_minutes)
+
+def load_hourly_summary(path):
+    """
+    Load a summary saved with save_hourly_summary
+    """
+    with np.load(path) as data:
+        last_timestamp = data['last_timestamp']
+        return HourlySummary(
+            data['counts'],
+            int(data['min_value']),
+            None if np.isnat(last_timestamp) else last_timestamp[()].astype(datetime),
+            int(data['bin_minutes']) if 'bin_minutes' in data else 60
+        )
+
+def hourly_stats_from_summary(summary):
+    """
+    Calculate the hourly stats of all readings in the summary
+    """
+    return hourly_stats_from_histogram(summary.counts, summary.min_value, summary.bin_minutes)
+
+@stage
+def rolling_hourly_stats(df, window_days, step_days=1, bin_minutes=60):
+    """
+    Calculate the hourly stats of sliding windows of window_days days, one
+    window ending every step_days days. The last window ends with the day
+    of the newest reading, and only windows that fit into the days with
+    readings are included. Returns one table with the first and last day of
+    each window in the Window Start and Window End columns.
+
+    The readings are counted per day, time bin and glucose value once. A
+    histogram (see hourly_histogram) is then slid over the days by adding
+    the counts of the days that enter the window and subtracting those of
+    the days that leave it, so every reading is counted twice at most, no
+    matter how much the windows overlap.
+    """
+    if is_empty(df):
+        return df
+
+    counts = df.lazy().group_by([
+        pl.col(TIME_COL_NAME).dt.epoch('d').alias('Day'),
+        time_bin(df.collect_schema()[TIME_COL_NAME], bin_minutes).alias('Bin'),
+        VALUE_COL_NAME
+    ]).agg(pl.len().alias('Count')).sort('Day').collect()
+
+    days = counts['Day'].to_numpy()
+    bins = counts['Bin'].to_numpy()
+    values = counts[VALUE_COL_NAME].to_numpy().astype(np.int64)
+    count = counts['Count'].to_numpy().astype(np.int64)
+    if days.size == 0:
+        return pl.DataFrame()
+    min_value = values.min()
+    values = values - min_value
+
+    histogram = np.zeros((bins_per_day(bin_minutes), values.max() + 1), dtype=np.int64)
+
+    # index of the first count of the day in the counts sorted by day
+    def position(day):
+        return np.searchsorted(days, day)
+
+    ends = np.arange(days[-1] + 1, days[0] + window_days - 1, -step_days)[::-1]
+    low = high = days[0]
+    windows = []
+    for end in ends:
+        start = end - window_days
+        # the days before the window leave it, the new days at its end enter it
+        leaving = slice(position(low), position(min(start, high)))
+        np.subtract.at(histogram, (bins[leaving], values[leaving]), count[leaving])
+        entering = slice(position(max(start, high)), position(end))
+        np.add.at(histogram, (bins[entering], values[entering]), count[entering])
+        low, high = start, end
+
+        window_stats = hourly_stats_from_histogram(histogram, min_value, bin_minutes)
+        windows.append(window_stats.select([
+            pl.lit(np.datetime64(int(start), 'D')).alias('Window Start'),
+            pl.lit(np.datetime64(int(end) - 1, 'D')).alias('Window End'),
+            pl.all()
+        ]))
+
+    return pl.concat(windows) if windows else pl.DataFrame()
+
+def import_figure():
+    """
+    Import the matplotlib Figure class. matplotlib and scipy take most of the
+    startup time, so they are only imported once a plot is actually drawn.
+
+    Figures are used without pyplot: they are not registered in any global
+    state, so they can be drawn concurrently and are freed like any other
+    object once they are no longer referenced.
+    """
+    from matplotlib.figure import Figure
+    return Figure
+
+SMOOTHING_METHODS = ['bspline', 'periodic', 'pchip', 'none']
+
+def smooth_curves(x, y, resolution=300, method='bspline', period=24):
+    """
+    Smooth several curves that are sampled at the same x values at once.
+
+    y has one column per curve. All curves are fitted with a single spline
+    over the 2-D array and evaluated in one call, so the cost hardly depends
+    on the number of curves. The methods are a cubic B-spline ('bspline'), a
+    periodic cubic spline that continues from the end of the period to its
+    start ('periodic'), a shape preserving PCHIP interpolation ('pchip') or
+    no smoothing at all ('none'). Returns the x values and a (resolution x
+    curves) array of smoothed y values.
+    """
+    from scipy.interpolate import PchipInterpolator, make_interp_spline
+
+    if method == 'none':
+        return x, y
+
+    if method == 'periodic':
+        # close the curve by repeating the first point one period later, so
+        # the end of the period flows into its start (e.g. 23:00 into 0:00)
+        x = np.append(x, x[0] + period)
+        y = np.vstack([y, y[:1]])
+        interpolate = make_interp_spline(x, y, k=min(3, len(x) - 1), bc_type='periodic', axis=0)
+    elif method == 'pchip':
+        # PCHIP needs two points, a single one is returned as it is
+        if len(x) < 2:
+            return x, y
+        interpolate = PchipInterpolator(x, y, axis=0)
+    elif method == 'bspline':
+        interpolate = make_interp_spline(x, y, k=min(3, len(x) - 1), axis=0)
+    else:
+        raise ValueError(f'unknown smoothing method {method!r}, expected one of {SMOOTHING_METHODS}')
+
+    x_smooth = np.linspace(x[0], x[-1], resolution)
+    return x_smooth, interpolate(x_smooth)
+
+def smooth_hourly_stats(hourly_stats, resolution=300, method='periodic'):
+    """
+    Smooth the mean and percentile columns of the hourly stats with
+    smooth_curves. Returns the x values, in hours of the day, and a dict of
+    the smoothed values of each column.
+
+    The result is cached per stats table (and resolution and method), so
+    plotting the same stats again, e.g. when re-rendering, does not refit
+    the curves. The returned arrays are read-only for that reason.
+    """
+    columns = ['Mean Glucose Value', *PERCENTILES]
+    # bins of resampled readings that are all gaps have no stats to plot
+    hourly_stats = hourly_stats.filter(pl.col('Mean Glucose Value').is_not_null())
+    x = hourly_stats['Hour'].cast(pl.Float64).to_numpy()
+    if 'Minute' in hourly_stats.columns:
+        x = x + hourly_stats['Minute'].cast(pl.Float64).to_numpy() / 60
+    y = np.ascontiguousarray(hourly_stats.select(columns).to_numpy(), dtype=np.float64)
+
+    x_smooth, y_smooth = _smooth_cached(x.tobytes(), y.tobytes(), len(columns), resolution, method)
+    return x_smooth, dict(zip(columns, y_smooth.T))
+
+@functools.lru_cache(maxsize=256)
+def _smooth_cached(x_bytes, y_bytes, curves, resolution, method):
+    x = np.frombuffer(x_bytes, dtype=np.float64)
+    y = np.frombuffer(y_bytes, dtype=np.float64).reshape(-1, curves)
+
+    x_smooth, y_smooth = smooth_curves(x, y, resolution, method)
+    x_smooth.setflags(write=False)
+    y_smooth.setflags(write=False)
+    return x_smooth, y_smooth
+
+@stage
+def plot_hourly_stats(hourly_stats, output_path=None, smoothing='periodic', resolution=300):
     """
     Plot the hourly mean, 25th percentile, and 75th percentile glucose values with a smooth line.
+
+    The areas between the percentiles are filled pairwise from the outside
+    in, e.g. 5th-95th and 25th-75th. By default the lines are smoothed as a
+    periodic curve over the whole day, from midnight to midnight.
+
+    The plot is written to output_path, which is a path or a binary file
+    object, e.g. an io.BytesIO to render the PNG in memory. Without an
+    output_path the matplotlib Figure is returned instead.
     """
-    # Convert to pandas DataFrame for plotting
-    hourly_stats_pd = hourly_stats.to_pandas()
+    Figure = import_figure()
 
-    # Generate smooth x-values
-    x = hourly_stats_pd['Hour']
-    x_smooth = np.linspace(x.min(), x.max(), 300)
+    fig = Figure()
+    ax = fig.add_subplot()
 
-    # Interpolate y-values for smooth lines
-    y_mean_smooth = make_interp_spline(x, hourly_stats_pd['Mean Glucose Value'])(x_smooth)
-    y_5th_smooth = make_interp_spline(x, hourly_stats_pd['5th Percentile'])(x_smooth)
-    y_25th_smooth = make_interp_spline(x, hourly_stats_pd['25th Percentile'])(x_smooth)
-    y_75th_smooth = make_interp_spline(x, hourly_stats_pd['75th Percentile'])(x_smooth)
-    y_95th_smooth = make_interp_spline(x, hourly_stats_pd['95th Percentile'])(x_smooth)
+    # Smooth the mean and all percentiles together
+    x_smooth, curves = smooth_hourly_stats(hourly_stats, resolution, smoothing)
 
     # Plot the smooth lines
-    plt.plot(x_smooth, y_mean_smooth, label='Mean Glucose Value')
-    plt.plot(x_smooth, y_5th_smooth, label='5th Percentile')
-    plt.plot(x_smooth, y_25th_smooth, label='25th Percentile')
-    plt.plot(x_smooth, y_75th_smooth, label='75th Percentile')
-    plt.plot(x_smooth, y_95th_smooth, label='95th Percentile')
+    for column, y in curves.items():
+        ax.plot(x_smooth, y, label=column)
 
     # Fill the areas between the percentiles
-    plt.fill_between(x_smooth, 80, 200, color='lightgreen', alpha=0.3, label='Target Range')
-    plt.fill_between(x_smooth, y_5th_smooth, y_95th_smooth, color='lightgray', alpha=0.5, label='5th-95th Percentile')
-    plt.fill_between(x_smooth, y_25th_smooth, y_75th_smooth, color='gray', alpha=0.5, label='25th-75th Percentile')
-
-    plt.xlabel('Hour of the Day')
-    plt.ylabel('Glucose Value (mg/dL)')
-    plt.title('Hourly Glucose Levels (95%, 75%, Mean, 25%, 5%)')
-    plt.grid(True)
-    plt.xticks(range(0, 24))
-    # plt.legend()
-    plt.savefig('plot.png')
+    ax.fill_between(x_smooth, 80, 200, color='lightgreen', alpha=0.3, label='Target Range')
+    percentiles = list(PERCENTILES)
+    for i, color in zip(range(len(percentiles) // 2), ['lightgray', 'gray', 'dimgray']):
+        lower, upper = percentiles[i], percentiles[-i - 1]
+        ax.fill_between(x_smooth, curves[lower], curves[upper], color=color, alpha=0.5,
+                         label=f"{lower.split()[0]}-{upper}")
+
+    ax.set_xlabel('Hour of the Day')
+    ax.set_ylabel('Glucose Value (mg/dL)')
+    ax.set_title('Hourly Glucose Levels (95%, 75%, Mean, 25%, 5%)')
+    ax.grid(True)
+    ax.set_xticks(range(0, 25))
+    ax.set_xlim(0, 24)
+    # ax.legend()
+
+    if output_path is None:
+        return fig
+    fig.savefig(output_path)
+    # Drop the artists right away instead of waiting for the garbage
+    # collector to break their reference cycles
+    fig.clear()
+
+def expand_input_paths(paths):
+    """
+    Expand directories to the exports in them, glob patterns to the files
+    they match and zip archives to the exports inside of them
+    """
+    expanded = []
+    for path in paths:
+        if os.path.isdir(path):
+            expanded.extend(export_files(path))
+        elif glob.has_magic(path):
+            expanded.extend(sorted(glob.glob(path)))
+        elif path.endswith('.zip') and os.path.isfile(path):
+            expanded.extend(zip_members(path))
+        else:
+            expanded.append(path)
+    return expanded
+
+@stage
+def collect_query(query, streaming=False):
+    """
+    Run a lazy query, on the streaming engine if asked to. A list of queries
+    is run together, so the parts they have in common are only run once.
+    """
+    engine = 'streaming' if streaming else 'auto'
+    if isinstance(query, list):
+        return pl.collect_all(query, engine=engine)
+    return query.collect(engine=engine)
+
+def process_export(file_path, output_path, args):
+    """
+    Read, clean and plot a single export. Returns the hourly stats. With
+    --stats-only nothing is plotted, and with --rolling the stats of every
+    window are returned instead of plotted.
+
+    A list of file paths is read as overlapping exports of one patient
+    (--merge), which bypasses the cache of the single exports. The number of
+    duplicate readings that were dropped is reported on stderr.
+    """
+    lazy = args.lazy or args.streaming or args.summary
+    duplicates = None
+    last = timedelta(days=args.last) if args.last else None
+
+    if isinstance(file_path, list):
+        readings = read_exported_dexcom_values(file_path, lazy=lazy, start=args.start, end=args.end)
+        duplicates = count_duplicate_readings(readings)
+        df = clean_data(readings)
+    elif args.no_cache:
+        df = clean_data(read_exported_dexcom_values(file_path, lazy=lazy, start=args.start, end=args.end))
+    else:
+        df = read_cleaned_readings(file_path, args.cache_dir, args.cache_size * 1024 * 1024)
+        if not lazy:
+            # filtered before collecting, so only the needed row groups are read
+            df = collect_query(filter_readings(df, args.start, args.end))
+
+    if args.summary:
+        summary = load_hourly_summary(args.summary) if os.path.exists(args.summary) else None
+        summary = update_hourly_summary(summary, df, args.bin_minutes)
+        save_hourly_summary(summary, args.summary)
+        hourly_stats = hourly_stats_from_summary(summary)
+    elif args.rolling:
+        hourly_stats = rolling_hourly_stats(filter_readings(df, args.start, args.end, last=last), args.rolling,
+                                            args.step, args.bin_minutes)
+    else:
+        hourly_stats = hourly_stats_of_readings(df, args)
+    if isinstance(hourly_stats, pl.LazyFrame) and isinstance(duplicates, pl.LazyFrame):
+        hourly_stats, duplicates = collect_query([hourly_stats, duplicates], args.streaming)
+    elif isinstance(hourly_stats, pl.LazyFrame):
+        hourly_stats = collect_query(hourly_stats, args.streaming)
+    if isinstance(duplicates, pl.LazyFrame):
+        duplicates = collect_query(duplicates, args.streaming)
+    if duplicates is not None:
+        print(f'Dropped {duplicates.item()} duplicate readings', file=sys.stderr)
+
+    if not args.stats_only and not args.rolling:
+        plot_hourly_stats(hourly_stats, output_path, args.smoothing, args.resolution)
+    return hourly_stats
+
+def hourly_stats_of_readings(df, args, patient=None):
+    """
+    Calculate the hourly stats of the cleaned readings of the patient with
+    the filters and bins of args. With --resample or --interpolate the
+    readings that pass the filters are resampled first, and the stats get
+    a Coverage column.
+    """
+    last = timedelta(days=args.last) if args.last else None
+    if not (args.resample or args.interpolate):
+        return calculate_hourly_stats(df, args.bin_minutes, args.start, args.end, patient, last)
+
+    # filtered first, so the grid only spans the readings that are kept
+    max_gap = timedelta(minutes=args.interpolate) if args.interpolate else None
+    df = resample_readings(filter_readings(df, args.start, args.end, patient, last), max_gap)
+    return calculate_hourly_stats(df, args.bin_minutes)
+
+def print_hourly_stats(hourly_stats, args):
+    """
+    Print the hourly stats, as csv with --stats-only so the output can be
+    processed further
+    """
+    if args.stats_only:
+        hourly_stats.write_csv(sys.stdout)
+    else:
+        print(hourly_stats)
+
+def profile_export(file_path, output_path, args):
+    """
+    Process a single export while measuring each of its stages, and report
+    the measurements as asked for by the --profile options
+    """
+    timings = []
+    add_stage_hook(timings.append, cprofile=bool(args.profile_dump))
+    try:
+        print_hourly_stats(process_export(file_path, output_path, args), args)
+    finally:
+        remove_stage_hook(timings.append)
+
+    print_stage_timings(timings)
+    if args.profile_json:
+        write_stage_timings(timings, args.profile_json)
+    if args.profile_dump and timings:
+        slowest = max(timings, key=lambda t: t.wall_seconds)
+        slowest.profile.dump_stats(args.profile_dump)
+        print(f'cProfile of the slowest stage ({slowest.name}) written to {args.profile_dump}', file=sys.stderr)
+
+def plot_output_path(file_path, output_dir):
+    """
+    Path of the plot of an export, <output_dir>/<input-stem>.png
+    """
+    return os.path.join(output_dir, f'{export_stem(file_path)}.png')
+
+def read_cleaned_export(file_path, args, evict=True):
+    """
+    Lazily read the cleaned readings of an export, through the cache unless
+    --no-cache is given, see read_cleaned_readings for evict
+    """
+    if args.no_cache:
+        return clean_data(read_exported_dexcom_values(file_path, lazy=True))
+    return read_cleaned_readings(file_path, args.cache_dir, args.cache_size * 1024 * 1024, evict)
+
+def process_store(file_paths, patient, args):
+    """
+    Append the exports to the store (--store), each as the patient given
+    with --patient or named after its file, and plot the stats of the
+    patient's readings in the store. Without a patient the stats of all
+    patients are returned and nothing is plotted. Returns the stats.
+    """
+    for file_path in file_paths:
+        append_to_store(read_cleaned_export(file_path, args), args.store,
+                        args.patient or export_stem(file_path))
+
+    hourly_stats = collect_query(hourly_stats_of_readings(scan_store(args.store), args, patient), args.streaming)
+    if patient is not None and not args.stats_only:
+        plot_hourly_stats(hourly_stats, args.output, args.smoothing, args.resolution)
+    return hourly_stats
+
+def process_exports_at_once(file_paths, args):
+    """
+    Calculate the hourly stats of many exports in a single query over all of
+    their readings, tagged with and grouped by the export they come from, and
+    print them as one csv with the export in the "File" column. Returns the
+    number of exports that failed.
+    """
+    readings = []
+    failures = 0
+    # exports that are read eagerly, like those in zip archives, are read
+    # in parallel; decompression and parsing release the GIL
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        # the cache is only evicted once the query over all exports ran, so
+        # no export's cache entry is removed before it is read
+        futures = [executor.submit(read_cleaned_export, file_path, args, evict=False) for file_path in file_paths]
+        for file_path, future in zip(file_paths, futures):
+            try:
+                readings.append(with_patient(future.result(), file_path))
+            except Exception as e:
+                failures += 1
+                print(f'{file_path} failed: {e}', file=sys.stderr)
+
+    if readings:
+        hourly_stats = collect_query(hourly_stats_of_readings(pl.concat(readings), args), args.streaming)
+        hourly_stats.rename({PATIENT_COL_NAME: 'File'}).write_csv(sys.stdout)
+        if not args.no_cache:
+            evict_cache(args.cache_dir, args.cache_size * 1024 * 1024)
+    return failures
+
+def process_exports(file_paths, output_dir, args):
+    """
+    Plot many exports in parallel, each into <output_dir>/<input-stem>.png.
+    The worker processes are reused between exports, so the imports are only
+    paid once per worker. With --stats-only the exports are processed
+    together by process_exports_at_once instead. Returns the number of
+    exports that failed.
+    """
+    if args.stats_only:
+        return process_exports_at_once(file_paths, args)
+
+    output_paths = [plot_output_path(file_path, output_dir) for file_path in file_paths]
+    failures = 0
+    os.makedirs(output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = {executor.submit(process_export, file_path, output_path, args): (file_path, output_path)
+                   for file_path, output_path in zip(file_paths, output_paths)}
+        for future in as_completed(futures):
+            file_path, output_path = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                print(f'{file_path} failed: {e}', file=sys.stderr)
+                continue
+            print(f'{file_path} -> {output_path}')
+
+    return failures
+
+class InotifyWatcher:
+    """
+    Report the exports and zip archives that were written or moved into a
+    directory, using the Linux inotify API through ctypes
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, directory):
+        self.directory = directory
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f'inotify_add_watch failed for {directory}')
+
+    def changes(self, timeout):
+        """
+        Wait up to timeout seconds for changes, returns the changed files
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+
+        changed = set()
+        buffer = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buffer):
+            _, _, _, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if is_export_source(name):
+                changed.add(os.path.join(self.directory, name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Report the exports and zip archives in a directory whose size or
+    modification time changed, by listing the directory periodically
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        for path in glob.glob(os.path.join(self.directory, '*')):
+            if not is_export_source(path):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def changes(self, timeout):
+        """
+        Wait timeout seconds and return the files changed in the meantime
+        """
+        time.sleep(timeout)
+        snapshot = self.scan()
+        changed = {path for path, state in snapshot.items() if self.snapshot.get(path) != state}
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+def open_watcher(directory, polling=False):
+    """
+    Watch the directory with inotify where it is available, falling back to
+    polling on other platforms and file systems
+    """
+    if not polling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directory)
+
+def watch_directory(directory, debounce=WATCH_DEBOUNCE, poll_interval=WATCH_POLL_INTERVAL, polling=False, stop=None,
+                    watcher=None):
+    """
+    Yield the exports and zip archives that were added to or changed in
+    directory, as sorted lists. Bursts of changes, like a sync job dropping several exports or a
+    file being written in chunks, are debounced: the files are only yielded
+    once nothing changed for debounce seconds. Runs until the stop event (a
+    threading.Event) is set.
+
+    A watcher opened by the caller (see open_watcher) reports the changes
+    made since it was opened, and is left for the caller to close.
+    """
+    if watcher is None:
+        watcher = opened = open_watcher(directory, polling)
+    else:
+        opened = None
+    pending = set()
+    try:
+        while stop is None or not stop.is_set():
+            changed = watcher.changes(debounce if pending else poll_interval)
+            if changed:
+                pending |= changed
+            elif pending:
+                yield sorted(pending)
+                pending = set()
+    finally:
+        if opened is not None:
+            opened.close()
+
+def stale_exports(directory, output_dir):
+    """
+    The exports in directory, including those in zip archives, whose plot is
+    missing or older than the export (or its archive)
+    """
+    stale = []
+    for file_path in export_files(directory):
+        zip_member = split_zip_member(file_path)
+        source = file_path if zip_member is None else zip_member[0]
+        output_path = plot_output_path(file_path, output_dir)
+        if not os.path.exists(output_path) or os.path.getmtime(output_path) < os.path.getmtime(source):
+            stale.append(file_path)
+    return stale
+
+def watch_exports(directory, output_dir, args, stop=None):
+    """
+    Plot every export that lands in directory into <output_dir>/<input-stem>.png
+    until interrupted, starting with the exports whose plot is out of date.
+    Everything runs in this process, so polars and matplotlib are only
+    imported once, and exports go through the cache of cleaned readings.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if not args.stats_only:
+        import_figure()
+
+    def render(file_paths):
+        for file_path in file_paths:
+            output_path = plot_output_path(file_path, output_dir)
+            try:
+                hourly_stats = process_export(file_path, output_path, args)
+            except Exception as e:
+                print(f'{file_path} failed: {e}', file=sys.stderr)
+                continue
+            if args.stats_only:
+                print_hourly_stats(hourly_stats.select(pl.lit(file_path).alias('File'), pl.all()), args)
+            else:
+                print(f'{file_path} -> {output_path}', flush=True)
+
+    # The watcher is opened before looking for stale exports, so the exports
+    # that land while those are rendered are not missed
+    watcher = open_watcher(directory)
+    try:
+        render(stale_exports(directory, output_dir))
+        for sources in watch_directory(directory, stop=stop, watcher=watcher):
+            file_paths = []
+            for source in sources:
+                if not os.path.exists(source):
+                    continue
+                try:
+                    file_paths.extend(source_exports(source))
+                except zipfile.BadZipFile as e:
+                    print(f'{source} failed: {e}', file=sys.stderr)
+            render(file_paths)
+    finally:
+        watcher.close()
+
+def hourly_stats_of_upload(data, bin_minutes=60):
+    """
+    Calculate the hourly stats of an export uploaded as csv bytes
+    """
+    df = clean_data(read_exported_dexcom_values(io.BytesIO(data)))
+    if df.is_empty():
+        raise ValueError('the export has no glucose readings')
+    return calculate_hourly_stats(df, bin_minutes)
+
+class PlotRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the hourly stats and plots of exports uploaded as the body of POST
+    requests:
+
+        POST /stats  returns the hourly stats as a JSON list of rows
+        POST /plot   returns the plot as a PNG image
+
+    The bin_minutes, smoothing and resolution query parameters override the
+    server defaults.
+    """
+    # HTTP/1.1 answers "Expect: 100-continue", which clients like curl send
+    # before uploading a large body. Connections are still closed after each
+    # request, so idle clients do not hold on to a worker.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.close_connection = True
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, explain='invalid Content-Length')
+            return
+        if length <= 0 or length > self.server.max_upload_size:
+            self.send_error(413 if length > 0 else 411)
+            return
+        # read the upload before its path and parameters are checked, so that
+        # the client gets to see an error response instead of a broken
+        # connection
+        data = self.rfile.read(length)
+
+        url = urllib.parse.urlsplit(self.path)
+        if url.path not in ('/stats', '/plot'):
+            self.send_error(404)
+            return
+
+        query = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            bin_minutes = int(query.get('bin_minutes', self.server.args.bin_minutes))
+            resolution = int(query.get('resolution', self.server.args.resolution))
+            smoothing = query.get('smoothing', self.server.args.smoothing)
+            if smoothing not in SMOOTHING_METHODS:
+                raise ValueError(f'unknown smoothing method {smoothing!r}')
+            if resolution <= 0:
+                raise ValueError(f'resolution must be positive, got {resolution}')
+            hourly_stats = hourly_stats_of_upload(data, bin_minutes)
+
+            if url.path == '/stats':
+                body = json.dumps(hourly_stats.to_dicts()).encode()
+                content_type = 'application/json'
+            else:
+                buffer = io.BytesIO()
+                plot_hourly_stats(hourly_stats, buffer, smoothing, resolution)
+                body = buffer.getvalue()
+                content_type = 'image/png'
+        except (ValueError, pl.exceptions.PolarsError) as e:
+            self.send_error(400, explain=str(e))
+            return
+        except Exception as e:
+            self.log_error('%s failed: %r', self.path, e)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class PlotServer(HTTPServer):
+    """
+    HTTP server that handles the requests on a fixed pool of worker threads.
+    At most queue_size requests wait for a worker, further requests are
+    answered with 503 Service Unavailable right away instead of piling up.
+    """
+    def __init__(self, address, args, workers=4, queue_size=16, max_upload_size=MAX_UPLOAD_SIZE, verbose=False):
+        super().__init__(address, PlotRequestHandler)
+        self.args = args
+        self.max_upload_size = max_upload_size
+        self.verbose = verbose
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            threading.Thread(target=self.reject_request, args=(request,), daemon=True).start()
+            return
+        self.executor.submit(self.process_request_in_worker, request, client_address)
+
+    def reject_request(self, request):
+        """
+        Answer 503 and drain what the client still sends for a moment, as
+        closing a socket with unread data resets the connection before the
+        client can read the response
+        """
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            request.shutdown(socket.SHUT_WR)
+            request.settimeout(REJECT_DRAIN_TIMEOUT)
+            while request.recv(64 * 1024):
+                pass
+        except OSError:
+            pass
+        finally:
+            request.close()
+
+    def process_request_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+def serve_plots(host, port, args):
+    """
+    Serve plots and stats over HTTP until interrupted, see PlotRequestHandler
+    """
+    import_figure()
+    with PlotServer((host, port), args, workers=args.jobs, queue_size=args.queue_size, verbose=True) as server:
+        print(f'Serving on http://{host}:{server.server_address[1]}', file=sys.stderr, flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+def start_time(value):
+    """
+    Parse the --from date or time
+    """
+    return datetime.fromisoformat(value)
+
+def end_time(value):
+    """
+    Parse the --to date or time. A date stands for the whole day, so the
+    readings up to the start of the next day are used.
+    """
+    end = datetime.fromisoformat(value)
+    return end + timedelta(days=1) if len(value) == len('YYYY-MM-DD') else end
 
 def main():
     parser = argparse.ArgumentParser(description='Plot hourly glucose levels from a CSV file.')
-    parser.add_argument('file_path', type=str, help='Path to the CSV file')
+    parser.add_argument('file_paths', type=str, nargs='*', metavar='file_path',
+                        help='Path to the CSV file. Several files, directories of CSV files and glob patterns '
+                             'can be given to plot many exports at once')
+    parser.add_argument('--watch', type=str, metavar='DIR',
+                        help='Keep running and plot every export that is added to or changed in DIR into '
+                             '--output-dir, starting with the exports whose plot is out of date')
+    parser.add_argument('--serve', type=int, metavar='PORT',
+                        help='Run an HTTP server on PORT that returns the plot (POST /plot) or the hourly stats as '
+                             'JSON (POST /stats) of the export in the request body')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address the HTTP server listens on (default: %(default)s)')
+    parser.add_argument('--queue-size', type=int, default=16,
+                        help='Number of requests that can wait for one of the --jobs workers of the HTTP server, '
+                             'further requests are rejected (default: %(default)s)')
+    parser.add_argument('--store', type=str, metavar='DIR',
+                        help='Append the readings of the input files to the Parquet store in DIR, partitioned by '
+                             'patient, year and month, and plot the readings of the patient from the store. '
+                             'Without input files only the store is read')
+    parser.add_argument('--patient', type=str,
+                        help='Patient of the readings in the store (default: the name of the input file)')
+    parser.add_argument('--merge', action='store_true',
+                        help='Read the files as overlapping exports of one patient, dropping the readings that '
+                             'appear in more than one of them, and plot them together')
+    parser.add_argument('--lazy', action='store_true',
+                        help='Build a single lazy query that only parses the needed columns and rows')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Run the lazy query on the streaming engine in bounded memory (implies --lazy)')
+    parser.add_argument('--summary', type=str, metavar='PATH',
+                        help='Fold only the readings newer than the summary at PATH into it (created if missing) '
+                             'and plot the stats of all summarized readings')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not read or write the cache of cleaned readings')
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help='Directory of the cache of cleaned readings (default: ~/.cache/dv)')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE // (1024 * 1024), metavar='MB',
+                        help='Maximum size of the cache in MB, least recently used entries are removed first '
+                             '(default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of exports to plot in parallel (default: number of CPUs)')
+    parser.add_argument('-o', '--output', type=str, default='plot.png', metavar='PATH',
+                        help='Path the plot of a single export is written to (default: %(default)s)')
+    parser.add_argument('--output-dir', type=str, default='.',
+                        help='Directory the plots of many exports are written to as <input-stem>.png '
+                             '(default: current directory)')
+    parser.add_argument('--from', type=start_time, dest='start', metavar='DATE',
+                        help='Only use the readings from this date (YYYY-MM-DD) or time (YYYY-MM-DDThh:mm:ss) on')
+    parser.add_argument('--to', type=end_time, dest='end', metavar='DATE',
+                        help='Only use the readings up to this date, including the whole day, or up to this time')
+    parser.add_argument('--last', type=int, metavar='DAYS',
+                        help='Only use the readings of the last DAYS days before the newest reading')
+    parser.add_argument('--rolling', type=int, metavar='DAYS',
+                        help='Print the stats of every window of DAYS days instead of plotting them, one window '
+                             'ending every --step days with the last one ending on the day of the newest reading')
+    parser.add_argument('--step', type=int, default=1, metavar='DAYS',
+                        help='Days between the ends of the --rolling windows (default: %(default)s)')
+    parser.add_argument('--bin-minutes', type=int, choices=[5, 10, 15, 20, 30, 60], default=60,
+                        help='Width of the time of day bins the stats are calculated for, in minutes. A summary '
+                             'keeps the bins it was created with (default: %(default)s)')
+    parser.add_argument('--resample', action='store_true',
+                        help='Align the readings to a regular 5-minute grid before calculating the stats, which '
+                             'get a Coverage column with the share of each bin that has measured readings')
+    parser.add_argument('--interpolate', type=int, metavar='MINUTES',
+                        help='Fill gaps of up to MINUTES of missing readings by linear interpolation between the '
+                             'readings around them (implies --resample)')
+    parser.add_argument('--smoothing', choices=SMOOTHING_METHODS, default='periodic',
+                        help='How the hourly values are smoothed in the plot (default: %(default)s)')
+    parser.add_argument('--resolution', type=int, default=300,
+                        help='Number of points of the smoothed lines (default: %(default)s)')
+    parser.add_argument('--stats-only', action='store_true',
+                        help='Print the hourly stats as csv instead of plotting them')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print the wall time, CPU time, peak memory and row count of each stage')
+    parser.add_argument('--profile-json', type=str, metavar='PATH',
+                        help='Write the stage measurements to a JSON file (implies --profile)')
+    parser.add_argument('--profile-dump', type=str, metavar='PATH',
+                        help='Run the stages under cProfile and write the profile of the slowest one to a file '
+                             'that can be read with pstats (implies --profile)')
     args = parser.parse_args()
 
-    df = read_exported_dexcom_values(args.file_path)
-    df = clean_data(df)
-    hourly_stats = calculate_hourly_stats(df)
-    plot_hourly_stats(hourly_stats)
+    if args.summary and (args.start or args.end or args.last or args.rolling):
+        parser.error('--summary keeps all readings, it can not be combined with --from, --to, --last or --rolling')
+    if (args.resample or args.interpolate) and (args.summary or args.rolling):
+        parser.error('--resample and --interpolate can not be combined with --summary or --rolling')
+
+    if args.serve is not None:
+        if args.file_paths or args.watch or args.merge or args.summary:
+            parser.error('--serve can not be combined with input files, --watch, --merge or --summary')
+        serve_plots(args.host, args.serve, args)
+        return
+    if args.watch:
+        if args.file_paths or args.merge or args.summary or args.rolling:
+            parser.error('--watch can not be combined with input files, --merge, --summary or --rolling')
+        if args.profile or args.profile_json or args.profile_dump:
+            parser.error('--profile can only be used with a single input file')
+        try:
+            watch_exports(args.watch, args.output_dir, args)
+        except KeyboardInterrupt:
+            pass
+        return
+    if args.store:
+        if args.merge or args.summary or args.rolling:
+            parser.error('--store can not be combined with --merge, --summary or --rolling')
+        file_paths = expand_input_paths(args.file_paths)
+        patient = args.patient
+        if patient is None and len(file_paths) == 1:
+            patient = export_stem(file_paths[0])
+        if patient is None and not args.stats_only:
+            parser.error('--store needs a --patient to plot')
+        print_hourly_stats(process_store(file_paths, patient, args), args)
+        return
+    if not args.file_paths:
+        parser.error('the following arguments are required: file_path')
+
+    file_paths = expand_input_paths(args.file_paths)
+    if args.merge:
+        if not file_paths:
+            parser.error('no csv files found')
+        file_paths = [file_paths]
+    if args.merge or (file_paths == args.file_paths and len(file_paths) == 1):
+        if args.profile or args.profile_json or args.profile_dump:
+            profile_export(file_paths[0], args.output, args)
+        else:
+            print_hourly_stats(process_export(file_paths[0], args.output, args), args)
+        return
+
+    if not file_paths:
+        parser.error('no csv files found')
+    # --stats-only writes no plots, so only the plotted exports need distinct names
+    output_paths = [plot_output_path(file_path, args.output_dir) for file_path in file_paths]
+    if not args.stats_only and len(set(output_paths)) != len(output_paths):
+        parser.error('input files must have distinct names, as their plots are named after them')
+    if args.summary:
+        parser.error('--summary can only be used with a single input file')
+    if args.rolling:
+        parser.error('--rolling can only be used with a single input file')
+    if args.profile or args.profile_json or args.profile_dump:
+        parser.error('--profile can only be used with a single input file')
+
+    if process_exports(file_paths, args.output_dir, args):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -1,14 +1,66 @@
+import json
+import os
+import gzip
+import io
+import random
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import zipfile
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import astuple
+import numpy as np
 import pytest
 import polars as pl
 from polars.testing import assert_frame_equal
-from datetime import datetime
-
-from plot import calculate_hourly_stats, clean_data
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import plot
+from plot import (
+    PlotServer,
+    AgpMetrics,
+    HIGH_VALUE,
+    add_stage_hook,
+    append_to_store,
+    calculate_agp_metrics,
+    calculate_hourly_stats,
+    calculate_hourly_stats_and_agp_metrics,
+    clean_data,
+    count_duplicate_readings,
+    hourly_stats_from_summary,
+    load_hourly_summary,
+    evict_cache,
+    expand_input_paths,
+    merge_hourly_summaries,
+    plot_hourly_stats,
+    read_cleaned_readings,
+    read_exported_dexcom_values,
+    remove_stage_hook,
+    resample_readings,
+    rolling_hourly_stats,
+    save_hourly_summary,
+    scan_store,
+    smooth_curves,
+    smooth_hourly_stats,
+    stale_exports,
+    summarize_readings,
+    update_hourly_summary,
+    watch_directory,
+)
 
 TIME_COL_NAME = 'Timestamp (YYYY-MM-DDThh:mm:ss)'
 VALUE_COL_NAME = 'Glucose Value (mg/dL)'
 SCHEMA_CLEAN = {TIME_COL_NAME: pl.Datetime(time_zone=None), VALUE_COL_NAME: pl.Int32}
 SCHEMA_COMPUTED = {"Hour": pl.Int8, "Mean Glucose Value": pl.Float64, "5th Percentile": pl.Float64, "25th Percentile": pl.Float64, "75th Percentile": pl.Float64, "95th Percentile": pl.Float64}
+EXAMPLE_EXPORT = Path(__file__).parent / 'example' / 'example_export_data.csv'
+EXPORT_HEADER = '"Index","Timestamp (YYYY-MM-DDThh:mm:ss)","Event Type","Event Subtype","Patient Info","Device Info","Source Device ID","Glucose Value (mg/dL)","Insulin Value (u)","Carb Value (grams)","Duration (hh:mm:ss)","Glucose Rate of Change (mg/dL/min)","Transmitter Time (Long Integer)","Transmitter ID"'
 
 
 def test_empty_data_frame_will_not_break():
@@ -45,6 +97,32 @@ def test_low_value_is_replaced_with_30():
     assert_frame_equal(actual, expected)
 
 
+def test_high_value_row_is_removed():
+    input = pl.DataFrame({
+        TIME_COL_NAME: ["0001-01-01T00:00:00"],
+        VALUE_COL_NAME: ["High"]
+    })
+
+    actual = clean_data(input)
+
+    assert_frame_equal(actual, pl.DataFrame([], SCHEMA_CLEAN))
+
+
+def test_high_value_is_replaced_with_the_given_value():
+    input = pl.DataFrame({
+        TIME_COL_NAME: ["0001-01-01T00:00:00"],
+        VALUE_COL_NAME: ["High"]
+    })
+
+    actual = clean_data(input, HIGH_VALUE)
+
+    expected = pl.DataFrame({
+        TIME_COL_NAME: [t("0001-01-01T00:00:00")],
+        VALUE_COL_NAME: [401]
+    }, SCHEMA_CLEAN)
+    assert_frame_equal(actual, expected)
+
+
 def test_empty_time_row_is_removed():
     input = pl.DataFrame({
         TIME_COL_NAME: ["", " ", None],
@@ -287,8 +365,826 @@ def test_95th_percentile_value_flip():
     }, SCHEMA_COMPUTED)
     assert_frame_equal(actual, expected)
 
+def test_lazy_read_keeps_only_egv_rows_and_needed_columns(tmp_path):
+    path = write_export(tmp_path, [
+        '"1","","FirstName","","TestName","","","","","","","",""',
+        '"2","","Alert","High","","","iOS D1G7","200","","","","",""',
+        '"3","2024-06-06T00:10:42","EGV","","","","iOS D1G7","Low","","","","","573512","74xxxxxxxx11"',
+    ])
+
+    actual = read_exported_dexcom_values(path, lazy=True).collect()
+
+    expected = pl.DataFrame({
+        TIME_COL_NAME: ["2024-06-06T00:10:42"],
+        VALUE_COL_NAME: ["Low"]
+    })
+    assert_frame_equal(actual, expected)
+
+
+def test_eager_read_skips_metadata_rows_without_inferring_types(tmp_path):
+    path = write_export(tmp_path, [
+        '"1","","FirstName","","TestName","","","","","","","",""',
+        '"2","","Device","","","Dexcom G7 Mobile App","iOS D1G7","","","","","",""',
+        '"3","2024-06-06T00:10:42","EGV","","","","iOS D1G7","Low","","","","","573512","74xxxxxxxx11"',
+        '"4","2024-06-06T00:15:42","EGV","","","","iOS D1G7","104","","","","-1.5","573812","74xxxxxxxx11"',
+    ])
+
+    actual = read_exported_dexcom_values(path)
+
+    expected = pl.DataFrame({
+        TIME_COL_NAME: ["2024-06-06T00:10:42", "2024-06-06T00:15:42"],
+        VALUE_COL_NAME: ["Low", "104"]
+    })
+    assert_frame_equal(actual, expected)
+
+
+@pytest.mark.parametrize("header, message", [
+    (EXPORT_HEADER.replace("Glucose Value (mg/dL)", "Glucose Value (mmol/L)"),
+     "missing columns 'Glucose Value (mg/dL)'; unexpected columns 'Glucose Value (mmol/L)'"),
+    (EXPORT_HEADER + ',"Trend"', "unexpected columns 'Trend'"),
+    (EXPORT_HEADER.replace('"Index","Timestamp (YYYY-MM-DDThh:mm:ss)"', '"Timestamp (YYYY-MM-DDThh:mm:ss)","Index"'),
+     "the columns are in a different order"),
+], ids=["mmol/L values", "extra column", "reordered columns"])
+def test_exports_in_an_unknown_layout_are_rejected(tmp_path, header, message):
+    path = tmp_path / "export.csv"
+    path.write_text(header + "\n", encoding="utf-8-sig")
+    archive = tmp_path / "export.zip"
+    with zipfile.ZipFile(archive, "w") as f:
+        f.write(path, "export.csv")
+
+    for file_path in [path, f"{archive}/export.csv", [path, path]]:
+        with pytest.raises(ValueError, match=re.escape(message)):
+            read_exported_dexcom_values(file_path, lazy=True)
+    with pytest.raises(ValueError, match="the upload is not a Clarity export"):
+        plot.hourly_stats_of_upload(path.read_bytes())
+
+
+def test_lazy_pipeline_matches_eager_pipeline():
+    path = EXAMPLE_EXPORT
+
+    eager = calculate_hourly_stats(clean_data(read_exported_dexcom_values(path)))
+    lazy = calculate_hourly_stats(clean_data(read_exported_dexcom_values(path, lazy=True))).collect()
+
+    assert_frame_equal(lazy, eager, check_exact=True)
+
+def test_streaming_pipeline_matches_eager_pipeline():
+    eager = calculate_hourly_stats(clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+    streaming = calculate_hourly_stats(clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT, lazy=True))).collect(engine='streaming')
+
+    assert_frame_equal(streaming, eager, check_exact=True)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_stats_from_value_counts_match_quantiles(seed):
+    rng = random.Random(seed)
+    size = rng.randint(1, 500)
+    input = pl.DataFrame({
+        TIME_COL_NAME: [datetime(2024, 1, 1, rng.randrange(24)) for _ in range(size)],
+        VALUE_COL_NAME: [rng.randint(30, 400) for _ in range(size)]
+    }, SCHEMA_CLEAN)
+
+    actual = calculate_hourly_stats(input.lazy()).collect()
+    expected = calculate_hourly_stats(input)
+    assert_frame_equal(actual, expected, check_exact=True)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_histogram_stats_match_polars_quantiles(seed):
+    rng = random.Random(seed)
+    size = rng.randint(1, 500)
+    input = pl.DataFrame({
+        TIME_COL_NAME: [datetime(2024, 1, 1, rng.randrange(24)) for _ in range(size)],
+        VALUE_COL_NAME: [rng.randint(0, 400) for _ in range(size)]
+    }, SCHEMA_CLEAN)
+
+    actual = calculate_hourly_stats(input)
+
+    expected = input.group_by(pl.col(TIME_COL_NAME).dt.hour().alias("Hour")).agg([
+        pl.col(VALUE_COL_NAME).mean().alias("Mean Glucose Value"),
+        pl.col(VALUE_COL_NAME).quantile(0.05).alias("5th Percentile"),
+        pl.col(VALUE_COL_NAME).quantile(0.25).alias("25th Percentile"),
+        pl.col(VALUE_COL_NAME).quantile(0.75).alias("75th Percentile"),
+        pl.col(VALUE_COL_NAME).quantile(0.95).alias("95th Percentile"),
+    ]).sort("Hour")
+    assert_frame_equal(actual, expected, check_exact=True)
+
+@pytest.mark.parametrize("bin_minutes", [5, 15, 30])
+def test_sub_hourly_bins_match_polars_quantiles(bin_minutes):
+    rng = random.Random(bin_minutes)
+    size = 2000
+    input = pl.DataFrame({
+        TIME_COL_NAME: [datetime(2024, 1, 1, rng.randrange(24), rng.randrange(60)) for _ in range(size)],
+        VALUE_COL_NAME: [rng.randint(30, 400) for _ in range(size)]
+    }, SCHEMA_CLEAN)
+
+    actual = calculate_hourly_stats(input, bin_minutes)
+
+    bin_start = pl.col(TIME_COL_NAME).dt.truncate(f"{bin_minutes}m")
+    expected = input.group_by([
+        bin_start.dt.hour().cast(pl.Int8).alias("Hour"),
+        bin_start.dt.minute().cast(pl.Int8).alias("Minute")
+    ]).agg([
+        pl.col(VALUE_COL_NAME).mean().alias("Mean Glucose Value"),
+        pl.col(VALUE_COL_NAME).quantile(0.05).alias("5th Percentile"),
+        pl.col(VALUE_COL_NAME).quantile(0.25).alias("25th Percentile"),
+        pl.col(VALUE_COL_NAME).quantile(0.75).alias("75th Percentile"),
+        pl.col(VALUE_COL_NAME).quantile(0.95).alias("95th Percentile"),
+    ]).sort(["Hour", "Minute"])
+    assert_frame_equal(actual, expected, check_exact=True)
+    assert_frame_equal(calculate_hourly_stats(input.lazy(), bin_minutes).collect(), expected, check_exact=True)
+    assert_frame_equal(hourly_stats_from_summary(summarize_readings(input, bin_minutes)), expected, check_exact=True)
+
+
+def test_bins_must_divide_an_hour():
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+
+    with pytest.raises(ValueError):
+        calculate_hourly_stats(input, 7)
+
+
+def test_summaries_of_different_bins_are_not_merged():
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+
+    with pytest.raises(ValueError):
+        merge_hourly_summaries(summarize_readings(input), summarize_readings(input, 15))
+
+
+def test_agp_metrics_of_readings():
+    input = pl.DataFrame({
+        TIME_COL_NAME: [t("2024-01-01T00:00:00"), t("2024-01-01T00:05:00"), t("2024-01-01T00:10:00"), t("2024-01-01T00:25:00")],
+        VALUE_COL_NAME: [50, 60, 180, 300]
+    }, SCHEMA_CLEAN)
+
+    [actual] = calculate_agp_metrics(input)
+
+    assert actual.readings == 4
+    assert actual.mean == pytest.approx(147.5)
+    assert actual.standard_deviation == pytest.approx(np.std([50, 60, 180, 300], ddof=1))
+    assert actual.coefficient_of_variation == pytest.approx(100 * actual.standard_deviation / 147.5)
+    assert actual.gmi == pytest.approx(3.31 + 0.02392 * 147.5)
+    assert actual.sensor_wear == pytest.approx(100 * 4 / 6)
+    assert (actual.time_very_low, actual.time_low, actual.time_in_range, actual.time_high, actual.time_very_high) == (25, 25, 25, 0, 25)
+
+
+def test_agp_metrics_of_lazy_and_eager_readings_match():
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+
+    [actual] = calculate_agp_metrics(input.lazy(), streaming=True)
+
+    assert [actual] == calculate_agp_metrics(input)
+    assert actual.time_very_low + actual.time_low + actual.time_in_range + actual.time_high + actual.time_very_high == pytest.approx(100)
+
+
+def test_agp_metrics_count_high_readings_as_very_high():
+    input = clean_data(pl.DataFrame({
+        TIME_COL_NAME: ["2024-01-01T00:00:00", "2024-01-01T00:05:00"],
+        VALUE_COL_NAME: ["High", "100"]
+    }), HIGH_VALUE)
+
+    [actual] = calculate_agp_metrics(input)
+
+    assert actual.readings == 2
+    assert actual.time_very_high == 50
+
+
+def test_agp_metrics_are_calculated_per_patient():
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+    first, second = input.head(5000), input.tail(2000)
+    patients = pl.concat([
+        first.select(pl.lit("a").alias("Patient"), pl.all()),
+        second.select(pl.lit("b").alias("Patient"), pl.all()),
+    ])
+
+    actual = calculate_agp_metrics(patients.lazy())
+
+    assert [metrics.patient for metrics in actual] == ["a", "b"]
+    for metrics, readings in zip(actual, [first, second]):
+        [expected] = calculate_agp_metrics(readings)
+        assert astuple(metrics)[:-1] == pytest.approx(astuple(expected)[:-1])
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_hourly_stats_and_agp_metrics_are_calculated_together(lazy):
+    raw = read_exported_dexcom_values(EXAMPLE_EXPORT, lazy=lazy)
+    input = clean_data(raw, HIGH_VALUE)
+
+    hourly_stats, metrics = calculate_hourly_stats_and_agp_metrics(input, 30, streaming=True)
+
+    assert_frame_equal(hourly_stats, calculate_hourly_stats(clean_data(raw), 30).lazy().collect())
+    assert metrics == calculate_agp_metrics(input)
+
+
+def test_agp_metrics_of_no_readings_are_empty():
+    assert calculate_agp_metrics(pl.DataFrame([], SCHEMA_CLEAN)) == [AgpMetrics(0, *[None] * 10)]
+    assert calculate_agp_metrics(pl.DataFrame([], SCHEMA_CLEAN).lazy()) == [AgpMetrics(0, *[None] * 10)]
+    assert calculate_agp_metrics(pl.DataFrame([], {"Patient": pl.String, **SCHEMA_CLEAN})) == []
+
+
+def test_patient_key_is_kept_by_clean_data():
+    actual = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT, lazy=True, patient="example")).collect()
+
+    assert actual.columns == ["Patient", TIME_COL_NAME, VALUE_COL_NAME]
+    assert actual["Patient"].unique().to_list() == ["example"]
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_stats_are_grouped_by_patient(lazy):
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+    first, second = input.head(10000), input.tail(-10000)
+    patients = pl.concat([first.select(pl.lit("b").alias("Patient"), pl.all()),
+                          second.select(pl.lit("a").alias("Patient"), pl.all())])
+
+    actual = calculate_hourly_stats(patients.lazy() if lazy else patients, 30)
+    if lazy:
+        actual = actual.collect()
+
+    expected = pl.concat([
+        calculate_hourly_stats(second, 30).select(pl.lit("a").alias("Patient"), pl.all()),
+        calculate_hourly_stats(first, 30).select(pl.lit("b").alias("Patient"), pl.all())
+    ])
+    assert_frame_equal(actual, expected, check_exact=True)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_overlapping_exports_are_deduplicated(tmp_path, lazy):
+    first = write_export(tmp_path, [
+        '"1","2024-06-06T00:10:42","EGV","","","","iOS D1G7","100","","","","","573512","74xxxxxxxx11"',
+        '"2","2024-06-06T00:15:42","EGV","","","","iOS D1G7","110","","","","","573812","74xxxxxxxx11"',
+    ], name="first.csv")
+    second = write_export(tmp_path, [
+        '"1","2024-06-06T00:15:42","EGV","","","","iOS D1G7","110","","","","","573812","74xxxxxxxx11"',
+        '"2","2024-06-06T00:20:42","EGV","","","","iOS D1G7","120","","","","","",""',
+        '"3","2024-06-06T00:20:42","EGV","","","","iOS D1G7","120","","","","","",""',
+    ], name="second.csv")
+
+    readings = read_exported_dexcom_values([first, second], lazy=lazy)
+    actual = clean_data(readings).sort(TIME_COL_NAME)
+    duplicates = count_duplicate_readings(readings)
+    if lazy:
+        actual, duplicates = actual.collect(engine="streaming"), duplicates.collect(engine="streaming")
+
+    assert actual[VALUE_COL_NAME].to_list() == [100, 110, 120]
+    assert duplicates.item() == 2
+
+
+def test_overlapping_exports_in_a_zip_archive_are_deduplicated(tmp_path):
+    first = write_export(tmp_path, [
+        '"1","2024-06-06T00:10:42","EGV","","","","iOS D1G7","100","","","","","573512","74xxxxxxxx11"',
+        '"2","2024-06-06T00:15:42","EGV","","","","iOS D1G7","110","","","","","573812","74xxxxxxxx11"',
+    ], name="first.csv")
+    second = write_export(tmp_path, [
+        '"1","2024-06-06T00:15:42","EGV","","","","iOS D1G7","110","","","","","573812","74xxxxxxxx11"',
+        '"2","2024-06-06T00:20:42","EGV","","","","iOS D1G7","120","","","","","573812","74xxxxxxxx12"',
+    ], name="second.csv")
+    archive = tmp_path / "exports.zip"
+    with zipfile.ZipFile(archive, "w") as f:
+        f.write(first, "first.csv")
+        f.write(second, "second.csv")
+
+    readings = read_exported_dexcom_values(expand_input_paths([str(archive)]))
+    actual = clean_data(readings).sort(TIME_COL_NAME)
+
+    assert actual[VALUE_COL_NAME].to_list() == [100, 110, 120]
+    assert count_duplicate_readings(readings).item() == 1
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_readings_are_filtered_by_time_before_parsing(lazy):
+    start, end = datetime(2024, 7, 1), datetime(2024, 7, 15)
+
+    actual = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT, lazy=lazy, start=start, end=end))
+    if lazy:
+        assert 'Timestamp (YYYY-MM-DDThh:mm:ss)") >= "2024-07-01T00:00:00"' in actual.explain().split("SCAN")[1]
+        actual = actual.collect()
+
+    expected = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)).filter(
+        pl.col(TIME_COL_NAME).is_between(start, end, closed="left"))
+    assert_frame_equal(actual, expected)
+
+
+def test_stats_of_last_days_before_newest_reading():
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+    newest = input[TIME_COL_NAME].max()
+
+    actual = calculate_hourly_stats(input, last=timedelta(days=14))
+
+    expected = calculate_hourly_stats(input.filter(pl.col(TIME_COL_NAME) > newest - timedelta(days=14)))
+    assert_frame_equal(actual, expected, check_exact=True)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_readings_are_resampled_to_a_regular_grid(lazy):
+    input = pl.DataFrame({
+        TIME_COL_NAME: [datetime(2024, 6, 6, 0, 0, 10), datetime(2024, 6, 6, 0, 5, 12), datetime(2024, 6, 6, 0, 20, 9),
+                        datetime(2024, 6, 6, 0, 50, 1), datetime(2024, 6, 6, 0, 52, 40)],
+        VALUE_COL_NAME: pl.Series([100, 110, 140, 200, 210], dtype=pl.Int32),
+    })
+
+    actual = resample_readings(input.lazy() if lazy else input, max_gap=timedelta(minutes=10))
+
+    expected = pl.DataFrame({
+        TIME_COL_NAME: [datetime(2024, 6, 6, 0, minute) for minute in range(0, 55, 5)],
+        VALUE_COL_NAME: pl.Series([100, 110, 120, 130, 140, None, None, None, None, None, 205], dtype=pl.Int32),
+        "Gap": [False, False, True, True, False, True, True, True, True, True, False],
+    })
+    assert_frame_equal(actual.lazy().collect(), expected)
+
+
+def test_stats_of_resampled_readings_have_coverage():
+    resampled = resample_readings(clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+
+    actual = calculate_hourly_stats(resampled)
+
+    coverage = resampled.group_by(pl.col(TIME_COL_NAME).dt.hour().cast(pl.Int8).alias("Hour")).agg(
+        pl.col("Gap").not_().mean().alias("Coverage")).sort("Hour")
+    assert_frame_equal(actual.select(["Hour", "Coverage"]), coverage)
+    assert_frame_equal(actual.drop("Coverage"), calculate_hourly_stats(resampled.drop_nulls().drop("Gap")))
+
+    patients = resample_readings(pl.concat([
+        resampled.drop_nulls().drop("Gap").select(pl.lit(name).alias("Patient"), pl.all()) for name in ["a", "b"]
+    ]).lazy())
+    per_patient = calculate_hourly_stats(patients).collect()
+    assert_frame_equal(per_patient.filter(pl.col("Patient") == "b").drop("Patient"), actual)
+
+
+def test_bins_of_only_gaps_have_no_stats_and_no_coverage(tmp_path):
+    input = pl.DataFrame({
+        TIME_COL_NAME: [datetime(2024, 6, 6, 0, 0), datetime(2024, 6, 6, 2, 0)],
+        VALUE_COL_NAME: pl.Series([100, 200], dtype=pl.Int32),
+    })
+
+    actual = calculate_hourly_stats(resample_readings(input))
+
+    assert actual["Hour"].to_list() == [0, 1, 2]
+    assert actual["Coverage"].to_list() == [pytest.approx(1 / 12), 0.0, 1.0]
+    assert actual.row(1)[1:-1] == (None,) * 5
+    plot_hourly_stats(actual, tmp_path / "plot.png")
+
+
+@pytest.mark.parametrize("window_days, step_days", [(14, 1), (7, 10)])
+def test_rolling_stats_match_stats_of_each_window(window_days, step_days):
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+
+    actual = rolling_hourly_stats(input.lazy(), window_days, step_days)
+
+    windows = actual.select("Window Start", "Window End").unique(maintain_order=True).rows()
+    assert windows[-1][1] == input[TIME_COL_NAME].max().date()
+    for start, end in windows:
+        assert (end - start).days == window_days - 1
+        expected = calculate_hourly_stats(input, start=datetime.combine(start, datetime.min.time()),
+                                          end=datetime.combine(end, datetime.min.time()) + timedelta(days=1))
+        window = actual.filter(pl.col("Window Start") == start).drop("Window Start", "Window End")
+        assert_frame_equal(window, expected, check_exact=True)
+
+
+def test_stats_from_summary_match_stats_from_readings():
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+
+    actual = hourly_stats_from_summary(summarize_readings(input))
+
+    assert_frame_equal(actual, calculate_hourly_stats(input), check_exact=True)
+
+
+def test_merged_summaries_match_summary_of_all_readings():
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+    first, second = input.head(10000), input.tail(-10000)
+
+    actual = hourly_stats_from_summary(merge_hourly_summaries(summarize_readings(first), summarize_readings(second)))
+
+    assert_frame_equal(actual, calculate_hourly_stats(input), check_exact=True)
+
+
+def test_update_only_folds_newer_readings():
+    first = pl.DataFrame({
+        TIME_COL_NAME: [t("2024-01-01T00:00:00"), t("2024-01-01T01:00:00")],
+        VALUE_COL_NAME: [100, 200]
+    }, SCHEMA_CLEAN)
+    overlapping = pl.DataFrame({
+        TIME_COL_NAME: [t("2024-01-01T01:00:00"), t("2024-01-01T02:00:00")],
+        VALUE_COL_NAME: [200, 300]
+    }, SCHEMA_CLEAN)
+
+    summary = update_hourly_summary(update_hourly_summary(None, first), overlapping.lazy())
+
+    assert summary.last_timestamp == t("2024-01-01T02:00:00")
+    assert_frame_equal(hourly_stats_from_summary(summary), calculate_hourly_stats(pl.concat([first, overlapping.tail(1)])))
+
+
+def test_summary_survives_save_and_load(tmp_path):
+    summary = summarize_readings(clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+    path = tmp_path / "summary.npz"
+
+    save_hourly_summary(summary, path)
+    actual = load_hourly_summary(path)
+
+    assert actual.last_timestamp == summary.last_timestamp
+    assert actual.min_value == summary.min_value
+    assert actual.bin_minutes == summary.bin_minutes
+    assert (actual.counts == summary.counts).all()
+
+
+def test_empty_summary_survives_save_and_load(tmp_path):
+    path = tmp_path / "summary.npz"
+
+    save_hourly_summary(summarize_readings(pl.DataFrame([], SCHEMA_CLEAN)), path)
+
+    assert load_hourly_summary(path).last_timestamp is None
+
+def test_cleaned_readings_are_cached(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    expected = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+
+    first = read_cleaned_readings(EXAMPLE_EXPORT, cache_dir).collect()
+    monkeypatch.setattr(plot, "read_exported_dexcom_values", None)
+    second = read_cleaned_readings(EXAMPLE_EXPORT, cache_dir).collect()
+
+    assert_frame_equal(first, expected)
+    assert_frame_equal(second, expected)
+    assert len(list(cache_dir.iterdir())) == 1
+
+
+def test_cache_is_keyed_by_file_content(tmp_path):
+    cache_dir = tmp_path / "cache"
+    path = write_export(tmp_path, ['"1","2024-06-06T00:10:42","EGV","","","","iOS D1G7","100","","","","","573512","74xxxxxxxx11"'])
+    read_cleaned_readings(path, cache_dir)
+
+    path = write_export(tmp_path, ['"1","2024-06-06T00:10:42","EGV","","","","iOS D1G7","200","","","","","573512","74xxxxxxxx11"'])
+    actual = read_cleaned_readings(path, cache_dir).collect()
+
+    assert actual[VALUE_COL_NAME].to_list() == [200]
+    assert len(list(cache_dir.iterdir())) == 2
+
+
+def test_same_export_is_cached_by_several_threads_at_once(tmp_path):
+    cache_dir = tmp_path / "cache"
+    file_paths = []
+    for i in range(6):
+        file_paths.append(tmp_path / f"copy{i}.csv")
+        file_paths[-1].write_bytes(EXAMPLE_EXPORT.read_bytes())
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        scans = list(executor.map(lambda path: read_cleaned_readings(path, cache_dir), file_paths))
+
+    expected = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+    for scan in scans:
+        assert_frame_equal(scan.collect(), expected)
+    assert [p.suffix for p in cache_dir.iterdir()] == [".parquet"]
+
+
+def test_least_recently_used_cache_entries_are_evicted(tmp_path):
+    for age, name in enumerate(["newest", "middle", "oldest"]):
+        path = tmp_path / f"{name}.parquet"
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (1000 - age, 1000 - age))
+
+    evict_cache(tmp_path, 250)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["middle.parquet", "newest.parquet"]
+
+
+def test_new_cache_entry_is_kept_when_larger_than_the_cache(tmp_path):
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    (cache_dir / "old.parquet").write_bytes(b"x" * 100)
+
+    actual = read_cleaned_readings(EXAMPLE_EXPORT, cache_dir, max_cache_size=0).collect()
+
+    assert_frame_equal(actual, clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+    assert not (cache_dir / "old.parquet").exists()
+    assert len(list(cache_dir.iterdir())) == 1
+
+def test_batch_keeps_its_cache_entries_until_the_query_ran(tmp_path, capsys):
+    file_paths = []
+    for i in range(3):
+        path = tmp_path / f"v{i}.csv"
+        path.write_bytes(EXAMPLE_EXPORT.read_bytes() + f'"{i}","","FirstName","","","","","","","","","",""\n'.encode())
+        file_paths.append(str(path))
+    args = Namespace(jobs=1, no_cache=False, cache_dir=str(tmp_path / "cache"), cache_size=0, resample=False,
+                     interpolate=None, start=None, end=None, last=None, bin_minutes=60, streaming=False)
+
+    assert plot.process_exports_at_once(file_paths, args) == 0
+
+    stats = pl.read_csv(io.StringIO(capsys.readouterr().out))
+    assert stats["File"].unique(maintain_order=True).to_list() == file_paths
+    assert list((tmp_path / "cache").iterdir()) == []
+
+
+def test_store_keeps_appended_readings_once(tmp_path):
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+
+    append_to_store(input.head(10000), tmp_path, "123")
+    append_to_store(input.lazy(), tmp_path, "123")
+    actual = scan_store(tmp_path).collect()
+
+    assert actual["Patient"].unique().to_list() == ["123"]
+    assert_frame_equal(actual.select(input.columns).sort(input.columns), input.sort(input.columns))
+
+
+def test_store_queries_only_read_the_needed_partitions(tmp_path):
+    input = clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT))
+    append_to_store(input, tmp_path, "jane")
+    append_to_store(input, tmp_path, "john")
+    # every other partition is unreadable, so reading it would fail the query
+    for path in tmp_path.glob("**/*.parquet"):
+        if path.parent != tmp_path / "Patient=jane" / "Year=2024" / "Month=7":
+            path.write_bytes(b"not parquet")
+
+    actual = calculate_hourly_stats(scan_store(tmp_path), start=datetime(2024, 7, 10), end=datetime(2024, 7, 20),
+                                    patient="jane").collect()
+
+    expected = calculate_hourly_stats(input.filter(pl.col(TIME_COL_NAME).is_between(
+        datetime(2024, 7, 10), datetime(2024, 7, 20), closed="left")))
+    assert_frame_equal(actual.drop("Patient"), expected, check_exact=True)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_gzip_compressed_exports_are_read(tmp_path, lazy):
+    path = tmp_path / "export.csv.gz"
+    path.write_bytes(gzip.compress(EXAMPLE_EXPORT.read_bytes()))
+
+    actual = clean_data(read_exported_dexcom_values(path, lazy=lazy))
+
+    assert_frame_equal(actual.lazy().collect(), clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+
+
+def test_exports_in_zip_archives_are_read_in_chunks(tmp_path, monkeypatch):
+    archive = tmp_path / "exports.zip"
+    with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as f:
+        f.write(EXAMPLE_EXPORT, "first.csv")
+        f.write(EXAMPLE_EXPORT, "june/second.csv")
+        f.writestr("notes.txt", "not an export")
+    monkeypatch.setattr(plot, "ZIP_CHUNK_SIZE", 100_000)
+
+    file_paths = expand_input_paths([str(archive)])
+    actual = clean_data(read_exported_dexcom_values(file_paths[1], lazy=True)).collect()
+
+    assert file_paths == [f"{archive}/first.csv", f"{archive}/june/second.csv"]
+    assert plot.plot_output_path(file_paths[1], "plots") == "plots/second.png"
+    assert_frame_equal(actual, clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+
+
+def test_input_directories_and_globs_are_expanded(tmp_path):
+    for name in ["b.csv", "a.csv", "c.txt"]:
+        (tmp_path / name).write_text("")
+    explicit = str(tmp_path / "explicit.csv")
+
+    actual = expand_input_paths([str(tmp_path), str(tmp_path / "*.txt"), explicit])
+
+    assert actual == [str(tmp_path / "a.csv"), str(tmp_path / "b.csv"), str(tmp_path / "c.txt"), explicit]
+
+@pytest.mark.parametrize("polling", [False, True])
+def test_watched_directory_reports_new_exports_once(tmp_path, polling):
+    stop = threading.Event()
+    batches = []
+
+    def watch():
+        for file_paths in watch_directory(tmp_path, debounce=0.1, poll_interval=0.05, polling=polling, stop=stop):
+            batches.append(file_paths)
+            stop.set()
+
+    thread = threading.Thread(target=watch)
+    thread.start()
+    time.sleep(0.2)
+    write_export(tmp_path, [], name="first.csv")
+    write_export(tmp_path, [], name="second.csv")
+    with zipfile.ZipFile(tmp_path / "third.zip", "w") as f:
+        f.write(EXAMPLE_EXPORT, "third.csv")
+    (tmp_path / "plot.png").write_bytes(b"")
+    thread.join(timeout=5)
+    stop.set()
+
+    assert batches == [[str(tmp_path / "first.csv"), str(tmp_path / "second.csv"), str(tmp_path / "third.zip")]]
+
+
+def test_exports_landing_while_stale_exports_are_rendered_are_watched(tmp_path, monkeypatch):
+    write_export(tmp_path, [], name="stale.csv")
+    stop = threading.Event()
+    rendered = []
+
+    def process_export(file_path, output_path, args):
+        rendered.append(file_path)
+        if len(rendered) == 1:
+            write_export(tmp_path, [], name="landed.csv")
+        else:
+            stop.set()
+
+    monkeypatch.setattr(plot, "process_export", process_export)
+    thread = threading.Thread(target=plot.watch_exports,
+                              args=(tmp_path, tmp_path / "plots", Namespace(stats_only=False), stop))
+    thread.start()
+    thread.join(timeout=5)
+    stop.set()
+
+    assert rendered == [str(tmp_path / "stale.csv"), str(tmp_path / "landed.csv")]
+
+
+def test_exports_without_up_to_date_plot_are_stale(tmp_path):
+    plotted = write_export(tmp_path, [], name="plotted.csv")
+    write_export(tmp_path, [], name="new.csv")
+    with zipfile.ZipFile(tmp_path / "archive.zip", "w") as f:
+        f.write(plotted, "zipped.csv")
+    os.utime(plotted, (0, 0))
+    (tmp_path / "plotted.png").write_bytes(b"")
+
+    assert stale_exports(tmp_path, tmp_path) == [str(tmp_path / "archive.zip/zipped.csv"), str(tmp_path / "new.csv")]
+
+
+@pytest.fixture
+def plot_server():
+    def start(**kwargs):
+        server = PlotServer(("127.0.0.1", 0), Namespace(bin_minutes=60, resolution=300, smoothing="periodic"), **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_server_returns_stats_and_plot_of_upload(plot_server):
+    url = plot_server()
+    data = EXAMPLE_EXPORT.read_bytes()
+
+    with urllib.request.urlopen(url + "/stats?bin_minutes=30", data=data) as response:
+        stats = pl.DataFrame(json.loads(response.read()), schema_overrides={"Hour": pl.Int8, "Minute": pl.Int8})
+    with urllib.request.urlopen(url + "/plot", data=data) as response:
+        assert response.headers["Content-Type"] == "image/png"
+        assert response.read().startswith(b"\x89PNG")
+
+    expected = calculate_hourly_stats(clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)), 30)
+    assert_frame_equal(stats, expected)
+
+
+def test_server_rejects_invalid_uploads(plot_server):
+    url = plot_server()
+
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(url + "/stats", data=b"not an export")
+    assert e.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(url + "/other", data=EXAMPLE_EXPORT.read_bytes())
+    assert e.value.code == 404
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(url + "/plot?resolution=-5", data=EXAMPLE_EXPORT.read_bytes())
+    assert e.value.code == 400
+
+
+def test_server_rejects_an_invalid_content_length(plot_server):
+    url = plot_server()
+    host, port = url.removeprefix("http://").split(":")
+
+    with socket.create_connection((host, int(port))) as client:
+        client.sendall(b"POST /stats HTTP/1.1\r\nContent-Length: abc\r\n\r\n")
+        status_line = client.makefile("rb").readline()
+
+    assert status_line.split()[1] == b"400"
+
+
+def test_server_plots_an_upload_of_a_single_hour(plot_server, tmp_path):
+    url = plot_server()
+    path = write_export(tmp_path, [
+        '"1","2024-06-06T00:10:42","EGV","","","","iOS D1G7","100","","","","","573512","74xxxxxxxx11"',
+    ])
+
+    with urllib.request.urlopen(url + "/plot?smoothing=pchip", data=path.read_bytes()) as response:
+        assert response.read().startswith(b"\x89PNG")
+
+
+def test_server_answers_failed_plots_with_an_error(plot_server, monkeypatch):
+    url = plot_server()
+
+    def fail(*args):
+        raise RuntimeError("broken renderer")
+    monkeypatch.setattr(plot, "plot_hourly_stats", fail)
+
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(url + "/plot", data=EXAMPLE_EXPORT.read_bytes())
+    assert e.value.code == 500
+
+
+def test_server_rejects_requests_beyond_the_queue(plot_server):
+    url = plot_server(workers=1, queue_size=0)
+    host, port = url.removeprefix("http://").split(":")
+
+    # an unfinished request keeps the only worker busy
+    with socket.create_connection((host, int(port))) as busy:
+        busy.sendall(b"POST /stats HTTP/1.1\r\n")
+        time.sleep(0.2)
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + "/stats", data=EXAMPLE_EXPORT.read_bytes())
+    assert e.value.code == 503
+
+
+def test_stage_hooks_receive_outer_stage_timings(tmp_path):
+    timings = []
+    add_stage_hook(timings.append)
+    try:
+        raw = read_exported_dexcom_values(EXAMPLE_EXPORT)
+        df = clean_data(raw)
+        read_cleaned_readings(EXAMPLE_EXPORT, tmp_path)
+    finally:
+        remove_stage_hook(timings.append)
+    clean_data(raw)
+
+    assert [t.name for t in timings] == ["read_exported_dexcom_values", "clean_data", "read_cleaned_readings"]
+    assert timings[1].rows == df.height
+    assert all(t.wall_seconds >= 0 and t.peak_rss >= t.start_rss for t in timings)
+
+def test_stats_do_not_import_plotting_dependencies():
+    code = (
+        "import sys, plot\n"
+        f"plot.calculate_hourly_stats(plot.clean_data(plot.read_exported_dexcom_values({str(EXAMPLE_EXPORT)!r})))\n"
+        "print(sorted(m for m in ('matplotlib', 'scipy', 'pandas') if m in sys.modules))\n"
+    )
+
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=Path(__file__).parent)
+
+    assert result.stdout.strip() == "[]"
+
+@pytest.mark.parametrize("method", ["bspline", "periodic", "pchip"])
+def test_curves_are_smoothed_together_through_the_samples(method):
+    x = np.arange(24.0)
+    y = np.column_stack([np.sin(x), np.cos(x), x])
+
+    x_smooth, y_smooth = smooth_curves(x, y, resolution=24 * 10 + 1 if method == "periodic" else 23 * 10 + 1, method=method)
+
+    assert y_smooth.shape == (len(x_smooth), 3)
+    assert np.allclose(y_smooth[::10][:24], y)
+
+
+def test_periodic_smoothing_closes_the_curve():
+    x = np.arange(24.0)
+    y = np.column_stack([x, x ** 2])
+
+    x_smooth, y_smooth = smooth_curves(x, y, method="periodic")
+
+    assert x_smooth[0] == 0 and x_smooth[-1] == 24
+    assert np.allclose(y_smooth[0], y_smooth[-1])
+
+
+def test_smoothed_hourly_stats_are_cached_per_table():
+    hourly_stats = calculate_hourly_stats(clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+
+    first_x, first_curves = smooth_hourly_stats(hourly_stats)
+    second_x, second_curves = smooth_hourly_stats(hourly_stats.clone())
+    other_x, other_curves = smooth_hourly_stats(hourly_stats.with_columns(pl.col("Mean Glucose Value") + 1))
+
+    assert second_x is first_x
+    assert second_curves["Mean Glucose Value"].base is first_curves["Mean Glucose Value"].base
+    assert np.allclose(other_curves["Mean Glucose Value"], first_curves["Mean Glucose Value"] + 1)
+
+
+def test_plots_are_independent_figures():
+    hourly_stats = calculate_hourly_stats(clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+
+    first = plot_hourly_stats(hourly_stats)
+    second = plot_hourly_stats(hourly_stats)
+
+    assert first is not second
+    assert [len(fig.axes[0].lines) for fig in (first, second)] == [5, 5]
+    assert "matplotlib.pyplot" not in sys.modules
+
+
+def test_plot_is_written_to_file_objects():
+    hourly_stats = calculate_hourly_stats(clean_data(read_exported_dexcom_values(EXAMPLE_EXPORT)))
+    buffer = io.BytesIO()
+
+    assert plot_hourly_stats(hourly_stats, buffer) is None
+    assert buffer.getvalue().startswith(b"\x89PNG")
+
+
+def test_no_smoothing_returns_the_samples():
+    x = np.arange(24.0)
+    y = np.column_stack([x, x ** 2])
+
+    x_smooth, y_smooth = smooth_curves(x, y, method="none")
+
+    assert (x_smooth == x).all() and (y_smooth == y).all()
+
+
+def test_pchip_smoothing_of_a_single_sample_returns_it():
+    x, y = np.array([7.0]), np.array([[120.0, 80.0]])
+
+    x_smooth, y_smooth = smooth_curves(x, y, method="pchip")
+
+    assert (x_smooth == x).all() and (y_smooth == y).all()
+
+
+def test_unknown_smoothing_method_is_rejected():
+    with pytest.raises(ValueError):
+        smooth_curves(np.arange(24.0), np.zeros((24, 1)), method="unknown")
+
 # ====================
 # These are test helper functions
 
+
+def write_export(directory, rows, name="export.csv"):
+    path = directory / name
+    path.write_text("\n".join([EXPORT_HEADER] + rows) + "\n", encoding="utf-8-sig")
+    return path
+
 def t(datetime_string):
     return datetime.strptime(datetime_string, '%Y-%m-%dT%H:%M:%S')
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+
+import numpy as np
+import polars as pl
+
+COLUMNS = [
+    'Index',
+    'Timestamp (YYYY-MM-DDThh:mm:ss)',
+    'Event Type',
+    'Event Subtype',
+    'Patient Info',
+    'Device Info',
+    'Source Device ID',
+    'Glucose Value (mg/dL)',
+    'Insulin Value (u)',
+    'Carb Value (grams)',
+    'Duration (hh:mm:ss)',
+    'Glucose Rate of Change (mg/dL/min)',
+    'Transmitter Time (Long Integer)',
+    'Transmitter ID',
+]
+
+# Sizes of the benchmark data sets, as (number of patients, days per patient)
+SCALES = {
+    'month': (1, 30),
+    'year': (1, 365),
+    'decade': (1, 3652),
+    'patients': (100, 365),
+}
+
+SENSOR_DAYS = 10
+TRANSMITTER_DAYS = 90
+WARM_UP_READINGS = 24
+
+def synthetic_export(days, seed=0, start='2015-01-01T00:00:00'):
+    """
+    Generate a realistic Clarity export as a data frame of strings.
+
+    It has the patient and device metadata rows and some alerts at the top,
+    followed by an EGV every 5 minutes. The glucose values follow a daily
+    pattern with noise and are "Low"/"High" outside of 40-400 mg/dL. Each
+    sensor lasts 10 days and starts with a 2 hour warm-up without readings,
+    there are random signal losses, and the transmitter is replaced every
+    90 days, which restarts the transmitter time.
+    """
+    rng = np.random.default_rng(seed)
+    readings = days * 24 * 12
+
+    # 5-minute grid with a few seconds of jitter
+    seconds = np.arange(readings, dtype=np.int64) * 300 + rng.integers(0, 3, readings)
+    timestamps = np.datetime64(start, 's') + seconds
+
+    # daily pattern (higher after meals) with a different level every day,
+    # plus a slowly wandering random walk
+    minute_of_day = seconds // 60 % 1440
+    daily = 40 * np.sin(2 * np.pi * (minute_of_day - 360) / 1440) + 25 * np.sin(6 * np.pi * minute_of_day / 1440)
+    day_level = np.repeat(rng.normal(0, 35, days), 288)
+    walk = np.cumsum(rng.normal(0, 5, readings))
+    walk -= np.convolve(walk, np.ones(288) / 288, mode='same')
+    glucose = np.rint(140 + daily + day_level + walk + rng.normal(0, 8, readings)).astype(np.int64)
+    values = glucose.astype(str).astype(object)
+    values[glucose < 40] = 'Low'
+    values[glucose > 400] = 'High'
+
+    # sensor warm-ups and signal losses of 30 minutes to 6 hours
+    missing = np.zeros(readings, dtype=bool)
+    for sensor_start in range(0, readings, SENSOR_DAYS * 288):
+        missing[sensor_start:sensor_start + WARM_UP_READINGS] = True
+    for loss_start in rng.choice(readings, size=max(1, days // 3), replace=False):
+        missing[loss_start:loss_start + rng.integers(6, 72)] = True
+
+    transmitter = np.arange(readings) // (TRANSMITTER_DAYS * 288)
+    transmitter_ids = np.array([f'8{seed:05d}{i:04d}' for i in range(transmitter.max() + 1)])
+    transmitter_time = seconds - transmitter * TRANSMITTER_DAYS * 86400 + 500000
+
+    keep = ~missing
+    egv = pl.DataFrame({
+        'Timestamp (YYYY-MM-DDThh:mm:ss)': timestamps[keep].astype(str),
+        'Glucose Value (mg/dL)': pl.Series(values[keep], dtype=pl.String),
+        'Transmitter Time (Long Integer)': transmitter_time[keep].astype(str),
+        'Transmitter ID': transmitter_ids[transmitter[keep]],
+    }).with_columns([
+        pl.lit('EGV').alias('Event Type'),
+        pl.lit('iOS G7').alias('Source Device ID'),
+    ])
+
+    metadata = pl.DataFrame({
+        'Event Type': ['FirstName', 'LastName', 'Device', 'Alert', 'Alert', 'Alert', 'Alert'],
+        'Event Subtype': [None, None, None, 'High', 'Low', 'Urgent Low', 'Signal Loss'],
+        'Patient Info': ['Synthetic', f'Patient {seed}', None, None, None, None, None],
+        'Device Info': [None, None, 'Dexcom G7 Mobile App', None, None, None, None],
+        'Source Device ID': [None, None, 'iOS G7', 'iOS G7', 'iOS G7', 'iOS G7', 'iOS G7'],
+        'Glucose Value (mg/dL)': [None, None, None, '200', '80', '55', None],
+        'Duration (hh:mm:ss)': [None, None, None, None, None, None, '00:20:00'],
+    })
+
+    export = pl.concat([metadata, egv], how='diagonal')
+    return export.with_columns(
+        pl.int_range(1, pl.len() + 1).cast(pl.String).alias('Index'),
+        *[pl.lit(None, dtype=pl.String).alias(c) for c in COLUMNS if c not in export.columns and c != 'Index']
+    ).select(COLUMNS)
+
+def write_synthetic_export(path, days, seed=0):
+    """
+    Write a synthetic Clarity export in the same format as the website: a
+    byte order mark and every field quoted
+    """
+    synthetic_export(days, seed).write_csv(path, quote_style='always', include_bom=True)
+
+def write_synthetic_exports(directory, scale):
+    """
+    Write the exports of one of the SCALES into directory, one file per
+    patient. Existing files are kept, as the exports are deterministic.
+    Returns the file paths.
+    """
+    patients, days = SCALES[scale]
+    os.makedirs(directory, exist_ok=True)
+
+    paths = []
+    for patient in range(patients):
+        path = os.path.join(directory, f'{scale}-{patient:03d}.csv')
+        if not os.path.exists(path):
+            write_synthetic_export(path, days, seed=patient)
+        paths.append(path)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic DexCom Clarity exports.')
+    parser.add_argument('directory', type=str, help='Directory to write the exports to')
+    parser.add_argument('--scale', choices=SCALES, default='month',
+                        help='Number of patients and length of the exports (default: %(default)s)')
+    args = parser.parse_args()
+
+    for path in write_synthetic_exports(args.directory, args.scale):
+        print(path)
+
+if __name__ == "__main__":
+    main()